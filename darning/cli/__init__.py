@@ -23,6 +23,7 @@ from . import subcmd_init
 from . import subcmd_new
 from . import subcmd_push
 from . import subcmd_pop
+from . import subcmd_goto
 from . import subcmd_add
 from . import subcmd_refresh
 from . import subcmd_import
@@ -38,6 +39,8 @@ from . import subcmd_fold
 from . import subcmd_absorb
 from . import subcmd_rename
 from . import subcmd_validate
+from . import subcmd_convert
+from . import subcmd_gc
 from . import subcmd_duplicate
 from . import subcmd_delete
 from . import subcmd_select
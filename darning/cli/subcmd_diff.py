@@ -19,6 +19,8 @@ import sys
 
 from ..bab import CmdResult
 
+from .. import diff_engines
+
 from . import cli_args
 from . import db_utils
 
@@ -48,6 +50,13 @@ PARSER.add_argument(
     action="store_true"
 )
 
+PARSER.add_argument(
+    "--engine",
+    dest="opt_engine",
+    choices=diff_engines.ENGINES,
+    help=_("the algorithm to use (instead of the configured one) to generate the \"diff\" for applied patches."),
+)
+
 PARSER.add_argument(
     "filepaths",
     metavar=_("file"),
@@ -60,9 +69,9 @@ def run_diff(args):
     PM = db_utils.get_pm_db()
     db_utils.set_report_context(verbose=True)
     if args.opt_combined:
-        diff = PM.get_combined_diff_for_files(args.filepaths, args.opt_withtimestamps)
+        diff = PM.get_combined_diff_for_files(args.filepaths, args.opt_withtimestamps, args.opt_engine)
     else:
-        diff = PM.get_diff_for_files(args.filepaths, args.opt_patch, args.opt_withtimestamps)
+        diff = PM.get_diff_for_files(args.filepaths, args.opt_patch, args.opt_withtimestamps, args.opt_engine)
     if diff is False:
         return CmdResult.ERROR
     sys.stdout.write(diff)
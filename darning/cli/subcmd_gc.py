@@ -0,0 +1,32 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Compact the patch database and pack its stored file contents."""
+
+from . import cli_args
+from . import db_utils
+
+PARSER = cli_args.SUB_CMD_PARSER.add_parser(
+    "gc",
+    description=_("Compact the patch database and move its stored file contents into a pack file."),
+)
+
+def run_gc(args):
+    """Execute the "gc" sub command using the supplied args"""
+    PM = db_utils.get_pm_db()
+    db_utils.set_report_context(verbose=True)
+    return PM.do_gc()
+
+PARSER.set_defaults(run_cmd=run_gc)
@@ -0,0 +1,63 @@
+### Copyright (C) 2010 Peter Williams <peter_ono@users.sourceforge.net>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Push or pop patches until the nominated patch is on top."""
+
+from . import cli_args
+from . import db_utils
+
+PARSER = cli_args.SUB_CMD_PARSER.add_parser(
+    "goto",
+    description=_("Push or pop patches until the nominated patch is the top patch."),
+    epilog=_("""If the nominated patch is applied, patches are popped.  If the
+    top patch has unrefreshed changes the pop will be aborted unless the
+    force option is specified (in which case the changes are discarded).
+    Otherwise, patches are pushed.  If any of the files in the patches to
+    be pushed have uncommitted changes from the point of view of the SCM
+    controlling the sources or unrefreshed changes in an applied patch
+    below the top patch the push will be aborted unless either the force
+    or the absorb option is specified."""),
+)
+
+PARSER.add_argument(
+    "patchname",
+    metavar=_("patchname"),
+    help=_("the name of the patch that is to become the top patch."),
+)
+
+PARSER.add_argument(
+    "--restore-mtime",
+    help=_("give files restored by the pops or pushes their recorded modify times (overriding the \"pop.restore_mtime\" and \"push.restore_mtime\" options)."),
+    dest="opt_restore_mtime",
+    action="store_const",
+    const=True,
+    default=None,
+)
+
+GROUP = PARSER.add_mutually_exclusive_group()
+
+cli_args.add_force_option(GROUP, helptext=_("force the operation: when pushing, leave uncommitted/unrefreshed changes to the pushed patches' files out of the pushed patches; when popping, discard the top patch's unrefreshed changes."))
+
+cli_args.add_absorb_option(GROUP, helptext=_("absorb/incorporate uncommitted/unrefreshed changes to the pushed patches' files into the pushed patches."))
+
+cli_args.add_quiet_option(GROUP, helptext=_("operate quietly.  Only abnormal results will be reported."))
+
+def run_goto(args):
+    """Execute the "goto" sub command using the supplied args"""
+    PM = db_utils.get_pm_db()
+    db_utils.set_report_context(verbose=not args.opt_quiet)
+    return PM.do_goto_patch(args.patchname, absorb=args.opt_absorb, force=args.opt_force, restore_mtime=args.opt_restore_mtime)
+
+PARSER.set_defaults(run_cmd=run_goto)
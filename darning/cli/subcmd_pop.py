@@ -30,17 +30,22 @@ PARSER.add_argument(
     action="store_true",
 )
 
+PARSER.add_argument(
+    "--restore-mtime",
+    help=_("give restored files their modify times from before the patch was pushed (overriding the \"pop.restore_mtime\" option)."),
+    dest="opt_restore_mtime",
+    action="store_const",
+    const=True,
+    default=None,
+)
+
 def run_pop(args):
     """Execute the "pop" sub command using the supplied args"""
     PM = db_utils.get_pm_db()
     db_utils.set_report_context(verbose=True)
     if args.opt_all:
-        while PM.get_applied_patch_count():
-            result = PM.do_unapply_top_patch()
-            if result:
-                return result
-        return 0
+        return PM.do_unapply_patches(restore_mtime=args.opt_restore_mtime)
     else:
-        return PM.do_unapply_top_patch()
+        return PM.do_unapply_top_patch(restore_mtime=args.opt_restore_mtime)
 
 PARSER.set_defaults(run_cmd=run_pop)
@@ -35,6 +35,15 @@ PARSER.add_argument(
     action="store_true",
 )
 
+PARSER.add_argument(
+    "--restore-mtime",
+    help=_("give restored files their modify times from when the patch was refreshed (overriding the \"push.restore_mtime\" option)."),
+    dest="opt_restore_mtime",
+    action="store_const",
+    const=True,
+    default=None,
+)
+
 GROUP = PARSER.add_mutually_exclusive_group()
 
 cli_args.add_force_option(GROUP, helptext=_("force the operation and leave uncommitted/unrefreshed changes to the pushed patch's files out of the pushed patch."))
@@ -48,12 +57,8 @@ def run_push(args):
     PM = db_utils.get_pm_db()
     db_utils.set_report_context(verbose=not args.opt_quiet)
     if args.opt_all:
-        while PM.is_pushable():
-            result = PM.do_apply_next_patch(absorb=args.opt_absorb, force=args.opt_force)
-            if result:
-                return result
-        return 0
+        return PM.do_apply_patches(absorb=args.opt_absorb, force=args.opt_force, restore_mtime=args.opt_restore_mtime)
     else:
-        return PM.do_apply_next_patch(absorb=args.opt_absorb, force=args.opt_force)
+        return PM.do_apply_next_patch(absorb=args.opt_absorb, force=args.opt_force, restore_mtime=args.opt_restore_mtime)
 
 PARSER.set_defaults(run_cmd=run_push)
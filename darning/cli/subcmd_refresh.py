@@ -23,7 +23,16 @@ PARSER = cli_args.SUB_CMD_PARSER.add_parser(
     description=_("Refresh the top (or nominated) patch."),
 )
 
-cli_args.add_patch_option(PARSER, helptext=_("the name of the patch to be refreshed."))
+GROUP = PARSER.add_mutually_exclusive_group()
+
+cli_args.add_patch_option(GROUP, helptext=_("the name of the patch to be refreshed."))
+
+GROUP.add_argument(
+    "--all",
+    help=_("refresh all applied patches (from the bottom up)."),
+    dest="opt_all",
+    action="store_true",
+)
 
 cli_args.add_verbose_option(PARSER, helptext=_("display diff output."))
 
@@ -31,6 +40,8 @@ def run_refresh(args):
     """Execute the "refresh" sub command using the supplied args"""
     PM = db_utils.get_pm_db()
     db_utils.set_report_context(verbose=args.opt_verbose)
+    if args.opt_all:
+        return PM.do_refresh_applied_patches()
     return PM.do_refresh_patch(args.opt_patch)
 
 PARSER.set_defaults(run_cmd=run_refresh)
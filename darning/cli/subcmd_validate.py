@@ -23,10 +23,19 @@ PARSER = cli_args.SUB_CMD_PARSER.add_parser(
     description=_("Validate consistency of content data."),
 )
 
+PARSER.add_argument(
+    "--full",
+    dest="opt_full",
+    help=_("check all stored content (not just that which is new or has changed since it was last checked)."),
+    action="store_true"
+)
+
+cli_args.add_verbose_option(PARSER, helptext=_("report progress and throughput."))
+
 def run_validate(args):
     """Execute the "new" sub command using the supplied args"""
     PM = db_utils.get_pm_db()
     db_utils.set_report_context(verbose=True)
-    return PM.report_blobs_status()
+    return PM.report_blobs_status(full=args.opt_full, verbose=args.opt_verbose)
 
 PARSER.set_defaults(run_cmd=run_validate)
@@ -0,0 +1,280 @@
+### Copyright (C) 2016 Peter Williams <pwil3058@gmail.com>
+###
+### This program is free software; you can redistribute it and/or modify
+### it under the terms of the GNU General Public License as published by
+### the Free Software Foundation; version 2 of the License only.
+###
+### This program is distributed in the hope that it will be useful,
+### but WITHOUT ANY WARRANTY; without even the implied warranty of
+### MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+### GNU General Public License for more details.
+###
+### You should have received a copy of the GNU General Public License
+### along with this program; if not, write to the Free Software
+### Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+Alternative line matching algorithms for generating unified diffs.
+
+The content is split into lines as bytes and each distinct line is
+replaced by an integer so that the algorithms only compare integers
+and only the lines that appear in the diff are decoded.
+"""
+
+import bisect
+import difflib
+import re
+
+ENGINES = ("difflib", "myers", "patience", "histogram")
+
+# Lines that occur more often than this aren't used as histogram anchors
+_MAX_HISTOGRAM_CHAIN = 64
+
+def _myers_split(a, b, alo, ahi, blo, bhi, blocks): # pylint: disable=unused-argument
+    """Find the middle of an optimal path through the edit graph
+    (working from both ends at once so that space is linear) and
+    return the regions either side of it.  Each region is returned
+    with the function to be used to split it.
+    """
+    n, m = ahi - alo, bhi - blo
+    max_d = (n + m + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d + 2
+    vf = [-1] * v_length
+    vb = [-1] * v_length
+    vf[v_offset + 1] = 0
+    vb[v_offset + 1] = 0
+    delta = n - m
+    front = delta % 2 != 0
+    kf_start = kf_end = kb_start = kb_end = 0
+    split = None
+    for d in range(max_d):
+        for k in range(-d + kf_start, d + 1 - kf_end, 2):
+            k_offset = v_offset + k
+            if k == -d or (k != d and vf[k_offset - 1] < vf[k_offset + 1]):
+                x = vf[k_offset + 1]
+            else:
+                x = vf[k_offset - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            vf[k_offset] = x
+            if x > n:
+                kf_end += 2
+            elif y > m:
+                kf_start += 2
+            elif front:
+                kb_offset = v_offset + delta - k
+                if 0 <= kb_offset < v_length and vb[kb_offset] != -1 and x >= n - vb[kb_offset]:
+                    split = (x, y)
+                    break
+        if split is not None:
+            break
+        for k in range(-d + kb_start, d + 1 - kb_end, 2):
+            k_offset = v_offset + k
+            if k == -d or (k != d and vb[k_offset - 1] < vb[k_offset + 1]):
+                x = vb[k_offset + 1]
+            else:
+                x = vb[k_offset - 1] + 1
+            y = x - k
+            while x < n and y < m and a[ahi - x - 1] == b[bhi - y - 1]:
+                x += 1
+                y += 1
+            vb[k_offset] = x
+            if x > n:
+                kb_end += 2
+            elif y > m:
+                kb_start += 2
+            elif not front:
+                kf_offset = v_offset + delta - k
+                if 0 <= kf_offset < v_length and vf[kf_offset] != -1:
+                    fx = vf[kf_offset]
+                    if fx >= n - x:
+                        split = (fx, v_offset + fx - kf_offset)
+                        break
+        if split is not None:
+            break
+    if split is None or split in ((0, 0), (n, m)):
+        return []
+    x, y = split
+    return [(alo, alo + x, blo, blo + y, _myers_split), (alo + x, ahi, blo + y, bhi, _myers_split)]
+
+def _patience_split(a, b, alo, ahi, blo, bhi, blocks):
+    """Match the lines that occur exactly once in each side (taking the
+    longest increasing sequence of them) and return the regions between
+    them.  Fall back to Myers for the region if there are none.
+    """
+    a_counts = dict()
+    for i in range(alo, ahi):
+        a_counts[a[i]] = a_counts.get(a[i], 0) + 1
+    b_counts = dict()
+    for j in range(blo, bhi):
+        b_counts[b[j]] = b_counts.get(b[j], 0) + 1
+    a_index = {a[i] : i for i in range(alo, ahi) if a_counts[a[i]] == 1}
+    pairs = [(a_index[b[j]], j) for j in range(blo, bhi) if b_counts[b[j]] == 1 and b[j] in a_index]
+    if not pairs:
+        return _myers_split(a, b, alo, ahi, blo, bhi, blocks)
+    # patience sort the pairs (which are in "b" order) by their "a" index
+    tops = []
+    top_indices = []
+    backlinks = []
+    for index, (i, _j) in enumerate(pairs):
+        pile = bisect.bisect_left(tops, i)
+        backlinks.append(top_indices[pile - 1] if pile else None)
+        if pile == len(tops):
+            tops.append(i)
+            top_indices.append(index)
+        else:
+            tops[pile] = i
+            top_indices[pile] = index
+    anchors = []
+    index = top_indices[-1]
+    while index is not None:
+        anchors.append(pairs[index])
+        index = backlinks[index]
+    anchors.reverse()
+    regions = []
+    for i, j in anchors:
+        regions.append((alo, i, blo, j, _patience_split))
+        blocks.append((i, j, 1))
+        alo, blo = i + 1, j + 1
+    regions.append((alo, ahi, blo, bhi, _patience_split))
+    return regions
+
+def _histogram_split(a, b, alo, ahi, blo, bhi, blocks):
+    """Find the longest common run containing the lines that occur
+    least often in "a" and return the regions either side of it.
+    Fall back to Myers for the region if all common lines are too common.
+    """
+    occurrences = dict()
+    for i in range(alo, ahi):
+        occurrences.setdefault(a[i], []).append(i)
+    best = None
+    j = blo
+    while j < bhi:
+        positions = occurrences.get(b[j])
+        next_j = j + 1
+        if positions is not None and len(positions) <= _MAX_HISTOGRAM_CHAIN:
+            for i in positions:
+                count = len(positions)
+                s_i, s_j = i, j
+                while s_i > alo and s_j > blo and a[s_i - 1] == b[s_j - 1]:
+                    s_i -= 1
+                    s_j -= 1
+                    count = min(count, len(occurrences[a[s_i]]))
+                e_i, e_j = i + 1, j + 1
+                while e_i < ahi and e_j < bhi and a[e_i] == b[e_j]:
+                    count = min(count, len(occurrences[a[e_i]]))
+                    e_i += 1
+                    e_j += 1
+                if best is None or count < best[0] or (count == best[0] and e_i - s_i > best[3]):
+                    best = (count, s_i, s_j, e_i - s_i)
+                next_j = max(next_j, e_j)
+        j = next_j
+    if best is None:
+        return _myers_split(a, b, alo, ahi, blo, bhi, blocks)
+    _count, i, j, size = best
+    blocks.append((i, j, size))
+    return [(alo, i, blo, j, _histogram_split), (i + size, ahi, j + size, bhi, _histogram_split)]
+
+_SPLITTERS = {
+    "myers" : _myers_split,
+    "patience" : _patience_split,
+    "histogram" : _histogram_split,
+}
+
+def get_matching_blocks(a, b, engine):
+    """Return the matching blocks (as per difflib.SequenceMatcher) for
+    the sequences "a" and "b" found by the named engine
+    """
+    blocks = []
+    # NB: a work list rather than recursion as regions can nest deeply
+    regions = [(0, len(a), 0, len(b), _SPLITTERS[engine])]
+    while regions:
+        alo, ahi, blo, bhi, splitter = regions.pop()
+        start = alo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        if alo > start:
+            blocks.append((start, blo - (alo - start), alo - start))
+        end = ahi
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        if ahi < end:
+            blocks.append((ahi, bhi, end - ahi))
+        if alo < ahi and blo < bhi:
+            regions.extend(splitter(a, b, alo, ahi, blo, bhi, blocks))
+    blocks.sort()
+    matching_blocks = []
+    for i, j, size in blocks:
+        if matching_blocks and matching_blocks[-1][0] + matching_blocks[-1][2] == i and matching_blocks[-1][1] + matching_blocks[-1][2] == j:
+            matching_blocks[-1] = (matching_blocks[-1][0], matching_blocks[-1][1], matching_blocks[-1][2] + size)
+        else:
+            matching_blocks.append((i, j, size))
+    matching_blocks.append((len(a), len(b), 0))
+    return matching_blocks
+
+class _Matcher(difflib.SequenceMatcher):
+    """A SequenceMatcher whose matching blocks are supplied rather than
+    found by difflib's own algorithm
+    """
+    def __init__(self, a, b, matching_blocks): # pylint: disable=super-init-not-called
+        self.a = a
+        self.b = b
+        self.opcodes = None
+        self._matching_blocks = matching_blocks
+    def get_matching_blocks(self):
+        return self._matching_blocks
+
+def _format_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return "{0}".format(start + 1)
+    return "{0},{1}".format(start + 1 if length else start, length)
+
+def _diff_line(prefix, line):
+    text = line.decode()
+    if text.endswith("\n"):
+        return [prefix + text]
+    return [prefix + text + "\n", "\\ No newline at end of file\n"]
+
+def _split_lines(content):
+    # NB: unlike bytes.splitlines() this doesn't treat a lone "\r" as
+    # the end of a line as patch(1) wouldn't
+    lines = re.split(b"(?<=\n)", content)
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+def generate_diff_lines(before, after, engine, num_context_lines=3):
+    """Return the unified diff lines (in the same form as those produced
+    by unified_diff.generate_diff_lines()) for the before and after
+    data found using the named engine
+    """
+    before_lines = _split_lines(before.content)
+    after_lines = _split_lines(after.content)
+    line_ids = dict()
+    a = [line_ids.setdefault(line, len(line_ids)) for line in before_lines]
+    b = [line_ids.setdefault(line, len(line_ids)) for line in after_lines]
+    matcher = _Matcher(a, b, get_matching_blocks(a, b, engine))
+    diff_lines = []
+    for group in matcher.get_grouped_opcodes(num_context_lines):
+        if not diff_lines:
+            diff_lines.append("--- {0}{1}\n".format(before.label, "\t" + before.timestamp if before.timestamp else ""))
+            diff_lines.append("+++ {0}{1}\n".format(after.label, "\t" + after.timestamp if after.timestamp else ""))
+        diff_lines.append("@@ -{0} +{1} @@\n".format(_format_range(group[0][1], group[-1][2]), _format_range(group[0][3], group[-1][4])))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in before_lines[i1:i2]:
+                    diff_lines.extend(_diff_line(" ", line))
+                continue
+            if tag in ("replace", "delete"):
+                for line in before_lines[i1:i2]:
+                    diff_lines.extend(_diff_line("-", line))
+            if tag in ("replace", "insert"):
+                for line in after_lines[j1:j2]:
+                    diff_lines.extend(_diff_line("+", line))
+    return diff_lines
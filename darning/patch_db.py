@@ -19,14 +19,21 @@ Implement a patch stack management database
 
 import os
 import stat
+import bisect
 import pickle
 import collections
+import functools
 import shutil
-import copy
 import difflib
+import hashlib
 import tempfile
 import re
+import mmap
+import sqlite3
+import struct
 import zlib
+import time
+import concurrent.futures
 
 from contextlib import contextmanager
 
@@ -45,6 +52,7 @@ from .patch_diff import unified_diff
 from . import ntuples
 from . import rctx as RCTX
 from . import mixins
+from . import diff_engines
 from .scm import scm_ifce
 
 from .pm import PatchState, FileStatus, Presence, Validity, PatchTableRow
@@ -52,7 +60,12 @@ from .pm import MERGE_CRE, patch_timestamp_str
 
 options.define("pop", "drop_added_tws", options.Defn(options.str_to_bool, True, _("Remove added trailing white space (TWS) from patch after pop")))
 options.define("push", "drop_added_tws", options.Defn(options.str_to_bool, True, _("Remove added trailing white space (TWS) from patch before push")))
+options.define("pop", "restore_mtime", options.Defn(options.str_to_bool, False, _("Give files restored by pop (or drop) their modify times from before the patch was pushed")))
+options.define("push", "restore_mtime", options.Defn(options.str_to_bool, False, _("Give files restored by push their modify times from when the patch was refreshed")))
 options.define("absorb", "drop_added_tws", options.Defn(options.str_to_bool, True, _("Remove added trailing white space (TWS) from patch before absorb")))
+options.define("blobs", "compress", options.Defn(options.str_to_bool, True, _("Store file contents compressed (in git's loose object format).  Existing stores are converted when next modified.")))
+options.define("diff", "engine", options.Defn(str, "difflib", _("Algorithm used to generate unified diffs: \"difflib\", \"myers\", \"patience\" or \"histogram\".")))
+options.define("diff", "workers", options.Defn(int, 0, _("Number of processes used to generate the diffs when many files are refreshed or diffed at once (0 means one per CPU).")))
 options.define("remove", "keep_patch_backup", options.Defn(options.str_to_bool, True, _("Keep back up copies of removed patches.  Facilitates restoration at a later time.")))
 
 # A convenience tuple for sending an original and patched version of something
@@ -64,8 +77,19 @@ _DIR_PATH = ".darning.dbd"
 _BLOBS_DIR_PATH = os.path.join(_DIR_PATH, "blobs")
 _PATCHES_DATA_FILE_PATH = os.path.join(_DIR_PATH, "patches_data")
 _BLOB_REF_COUNT_FILE_PATH = os.path.join(_DIR_PATH, "blob_ref_counts")
+_JOURNAL_FILE_PATH = os.path.join(_DIR_PATH, "patches_journal")
+_PATCH_SHARDS_DIR_PATH = os.path.join(_DIR_PATH, "patches")
+_SQLITE_DB_FILE_PATH = os.path.join(_DIR_PATH, "patches.sqlite")
 _DESCRIPTION_FILE_PATH = os.path.join(_DIR_PATH, "description")
 _LOCK_FILE_PATH = os.path.join(_DIR_PATH, "lock_db_ng")
+_STAT_CACHE_FILE_PATH = os.path.join(_DIR_PATH, "stat_cache")
+_BLOB_FORMAT_FILE_PATH = os.path.join(_DIR_PATH, "blob_format")
+_EXTRACTED_BLOBS_DIR_PATH = os.path.join(_DIR_PATH, "extracted_blobs")
+_PACKS_DIR_PATH = os.path.join(_DIR_PATH, "packs")
+_VERIFIED_BLOBS_FILE_PATH = os.path.join(_DIR_PATH, "verified_blobs")
+_DIFF_CACHE_DIR_PATH = os.path.join(_DIR_PATH, "diff_cache")
+# NB: this is outside the blobs directory so that it can't be taken for a blob
+_BLOB_TMP_FILE_PATH = os.path.join(_DIR_PATH, "blob" + os.extsep + "tmp")
 
 def get_blob_dir_path(git_hash):
     """Get path of directory containing the file that contains the
@@ -78,6 +102,295 @@ def get_blob_path(git_hash):
     """
     return os.path.join(_BLOBS_DIR_PATH, git_hash[:2], git_hash[2:])
 
+_GIT_HASH_CRE = re.compile(r"^[0-9a-f]{40}$")
+
+# Blobs are stored either "raw" or "zlib" compressed in git's loose object
+# format.  The store is "mixed" while it's being converted between the two.
+
+def _read_blob_format():
+    try:
+        with open(_BLOB_FORMAT_FILE_PATH, "r") as f_obj:
+            return f_obj.read().strip()
+    except OSError:
+        # NB: stores that predate compression have no format file
+        return "raw"
+
+def _encode_blob(content, blob_format):
+    if blob_format == "zlib":
+        return zlib.compress(b"blob %d\0" % len(content) + content)
+    return content
+
+def _decode_blob(data, blob_format, git_hash):
+    if blob_format == "zlib":
+        obj = zlib.decompress(data)
+        return obj[obj.index(b"\0") + 1:]
+    elif blob_format == "mixed":
+        # NB: a raw blob can't decompress to an object with its hash
+        try:
+            obj = zlib.decompress(data)
+        except zlib.error:
+            return data
+        if hashlib.sha1(obj).hexdigest() == git_hash:
+            return obj[obj.index(b"\0") + 1:]
+    return data
+
+def _convert_blobs(blob_format):
+    """Convert all stored blobs to the nominated format"""
+    _write_file_atomically(_BLOB_FORMAT_FILE_PATH, b"mixed")
+    for base_dir_path, _dir_names, file_names in os.walk(_BLOBS_DIR_PATH): # pylint: disable=unused-variable
+        for file_name in file_names:
+            blob_file_path = os.path.join(base_dir_path, file_name)
+            if not _GIT_HASH_CRE.match(os.path.basename(base_dir_path) + file_name):
+                # NB: older versions left temporary files here if interrupted
+                if file_name.endswith(os.extsep + "tmp"):
+                    os.remove(blob_file_path)
+                continue
+            with open(blob_file_path, "rb") as f_obj:
+                data = f_obj.read()
+            content = _decode_blob(data, "mixed", os.path.basename(base_dir_path) + file_name)
+            new_data = _encode_blob(content, blob_format)
+            if new_data != data:
+                with open(_BLOB_TMP_FILE_PATH, "wb") as f_obj:
+                    f_obj.write(new_data)
+                utils.do_turn_off_write_for_file(_BLOB_TMP_FILE_PATH)
+                os.replace(_BLOB_TMP_FILE_PATH, blob_file_path)
+    if os.path.isdir(_EXTRACTED_BLOBS_DIR_PATH):
+        shutil.rmtree(_EXTRACTED_BLOBS_DIR_PATH)
+    _write_file_atomically(_BLOB_FORMAT_FILE_PATH, blob_format.encode())
+
+_DELTA_COPY = struct.Struct(">BQQ") # op, base offset, length
+_DELTA_INSERT = struct.Struct(">BQ") # op, length (followed by the data)
+_DELTA_COPY_OP, _DELTA_INSERT_OP = 0, 1
+
+# Only this many of the places where a line occurs in the base are tried
+_DELTA_MAX_CANDIDATES = 4
+
+def _make_delta(base, target, max_length=None):
+    """Return instructions for constructing "target" from "base" (by
+    copying runs of lines from "base" and inserting the rest) or None
+    if they wouldn't be shorter than "max_length".  The lines of "base"
+    are indexed by content and each run of "target" lines is copied
+    from the longest of a few candidate runs in "base" (preferring the
+    one following the previous copy) so that the cost is linear even
+    for large and repetitive content.
+    """
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    base_offsets = [0]
+    positions = dict()
+    for index, line in enumerate(base_lines):
+        base_offsets.append(base_offsets[-1] + len(line))
+        positions.setdefault(line, []).append(index)
+    chunks = []
+    length = 0
+    insert_start = 0
+    insert_length = 0
+    i_next = 0
+    j = 0
+    while j < len(target_lines):
+        best_i, best_size = None, 0
+        candidates = positions.get(target_lines[j], None)
+        if candidates:
+            index = bisect.bisect_left(candidates, i_next)
+            for i in candidates[index:index + _DELTA_MAX_CANDIDATES] or candidates[:_DELTA_MAX_CANDIDATES]:
+                size = 1
+                while i + size < len(base_lines) and j + size < len(target_lines) and base_lines[i + size] == target_lines[j + size]:
+                    size += 1
+                if size > best_size:
+                    best_i, best_size = i, size
+        # NB: inserting short runs is cheaper than copying them
+        if best_i is None or base_offsets[best_i + best_size] - base_offsets[best_i] <= _DELTA_COPY.size:
+            insert_length += len(target_lines[j])
+            if max_length is not None and length + insert_length >= max_length:
+                return None
+            j += 1
+            continue
+        if j > insert_start:
+            data = b"".join(target_lines[insert_start:j])
+            chunks.append(_DELTA_INSERT.pack(_DELTA_INSERT_OP, len(data)))
+            chunks.append(data)
+            length += _DELTA_INSERT.size + len(data)
+            insert_length = 0
+        chunks.append(_DELTA_COPY.pack(_DELTA_COPY_OP, base_offsets[best_i], base_offsets[best_i + best_size] - base_offsets[best_i]))
+        length += _DELTA_COPY.size
+        if max_length is not None and length >= max_length:
+            return None
+        j += best_size
+        insert_start = j
+        i_next = best_i + best_size
+    if j > insert_start:
+        data = b"".join(target_lines[insert_start:j])
+        chunks.append(_DELTA_INSERT.pack(_DELTA_INSERT_OP, len(data)))
+        chunks.append(data)
+        length += _DELTA_INSERT.size + len(data)
+    if max_length is not None and length >= max_length:
+        return None
+    return b"".join(chunks)
+
+def _apply_delta(base, delta):
+    parts = []
+    index = 0
+    while index < len(delta):
+        if delta[index] == _DELTA_COPY_OP:
+            _op, offset, length = _DELTA_COPY.unpack_from(delta, index) # pylint: disable=unused-variable
+            index += _DELTA_COPY.size
+            parts.append(base[offset:offset + length])
+        else:
+            _op, length = _DELTA_INSERT.unpack_from(delta, index) # pylint: disable=unused-variable
+            index += _DELTA_INSERT.size
+            parts.append(delta[index:index + length])
+            index += length
+    return b"".join(parts)
+
+def _read_stored_blob(git_hash, blob_format, get_blob_packs):
+    """Return the content for "git_hash" from its loose blob or from the
+    first of the packs (returned by "get_blob_packs()") that has it
+    """
+    # NB: loose blobs are newer than those in packs so look there first
+    try:
+        with open(get_blob_path(git_hash), "rb") as f_obj:
+            return _decode_blob(f_obj.read(), blob_format, git_hash)
+    except FileNotFoundError:
+        for blob_pack in get_blob_packs():
+            content = blob_pack.get_content(git_hash)
+            if content is not None:
+                return content
+        raise
+
+class _BlobPack(object):
+    """A pack file containing many blobs (one after the other) and an
+    index of their hashes, sorted so that it can be binary searched, to
+    their offsets and lengths.  Both files are memory mapped.  The index
+    is written last so that a pack is only visible once it's complete.
+
+    A blob may be stored as a delta against another blob (its base) in
+    the same pack.  Chains of deltas are at most MAX_DELTA_DEPTH long.
+    """
+    MAX_DELTA_DEPTH = 10
+    _PACK_FORMATS = ("raw", "zlib")
+    _IDX_HDR = struct.Struct(">4sBI") # magic, blob format, blob count
+    # NB: packs written before delta compression have no base hash
+    _IDX_ENTRIES = {
+        b"DIDX": struct.Struct(">20sQQ"), # hash, offset, length
+        b"DID2": struct.Struct(">20sQQ20s"), # hash, offset, length, base hash (zero if none)
+    }
+    _IDX_MAGIC = b"DID2"
+    _NO_BASE = bytes(20)
+    def __init__(self, pack_name):
+        self.name = pack_name
+        with open(self.get_idx_path(pack_name), "rb") as f_obj:
+            self._idx = mmap.mmap(f_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, blob_format, self._count = self._IDX_HDR.unpack_from(self._idx, 0)
+        self._idx_entry = self._IDX_ENTRIES[magic]
+        self.blob_format = self._PACK_FORMATS[blob_format]
+        self._pack = None
+    @staticmethod
+    def get_pack_path(pack_name):
+        return os.path.join(_PACKS_DIR_PATH, pack_name + os.extsep + "pack")
+    @staticmethod
+    def get_idx_path(pack_name):
+        return os.path.join(_PACKS_DIR_PATH, pack_name + os.extsep + "idx")
+    @classmethod
+    def get_pack_names(cls):
+        if not os.path.isdir(_PACKS_DIR_PATH):
+            return []
+        return sorted(os.path.splitext(file_name)[0] for file_name in os.listdir(_PACKS_DIR_PATH) if file_name.endswith(os.extsep + "idx"))
+    def _find(self, git_hash):
+        key = bytes.fromhex(git_hash)
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            offset = self._IDX_HDR.size + mid * self._idx_entry.size
+            mid_key = self._idx[offset:offset + 20]
+            if mid_key < key:
+                low = mid + 1
+            elif mid_key > key:
+                high = mid
+            else:
+                entry = self._idx_entry.unpack_from(self._idx, offset)
+                base = entry[3].hex() if len(entry) > 3 and entry[3] != self._NO_BASE else None
+                return (entry[1], entry[2], base)
+        return None
+    def __contains__(self, git_hash):
+        return self._find(git_hash) is not None
+    def iter_hashes(self):
+        for index in range(self._count):
+            offset = self._IDX_HDR.size + index * self._idx_entry.size
+            yield self._idx[offset:offset + 20].hex()
+    def _get_data(self, offset, length):
+        if length == 0:
+            # NB: an empty pack file can't be mapped
+            return b""
+        if self._pack is None:
+            with open(self.get_pack_path(self.name), "rb") as f_obj:
+                self._pack = mmap.mmap(f_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.blob_format == "raw":
+            return self._pack[offset:offset + length]
+        # NB: decompress directly from the mapped memory
+        with memoryview(self._pack) as view, view[offset:offset + length] as data:
+            return zlib.decompress(data)
+    def get_content(self, git_hash):
+        """Return the content for "git_hash" (or None if it's not in this pack)"""
+        location = self._find(git_hash)
+        if location is None:
+            return None
+        offset, length, base = location
+        data = self._get_data(offset, length)
+        if base is not None:
+            return _apply_delta(self.get_content(base), data)
+        elif self.blob_format == "zlib":
+            return data[data.index(b"\0") + 1:]
+        return data
+    def close(self):
+        if self._pack is not None:
+            self._pack.close()
+        self._idx.close()
+    @classmethod
+    def write(cls, entries, blob_format):
+        """Write a pack containing the (git_hash, base_hash, data) entries
+        (where data is a delta if base_hash isn't None) and return its name
+        """
+        if not os.path.isdir(_PACKS_DIR_PATH):
+            os.mkdir(_PACKS_DIR_PATH)
+        idx_entries = []
+        written = set()
+        pack_hash = hashlib.sha1()
+        fd, tmp_file_path = tempfile.mkstemp(dir=_PACKS_DIR_PATH)
+        try:
+            with os.fdopen(fd, "wb") as f_obj:
+                offset = 0
+                for git_hash, base_hash, data in entries:
+                    # NB: a base has to precede its deltas so that there can't be cycles
+                    if git_hash in written or (base_hash is not None and base_hash not in written):
+                        raise ValueError(_("{0}: duplicate pack entry or bad delta base {1}.").format(git_hash, base_hash))
+                    written.add(git_hash)
+                    if base_hash is None:
+                        data = _encode_blob(data, blob_format)
+                        base_key = cls._NO_BASE
+                    else:
+                        data = zlib.compress(data) if blob_format == "zlib" else data
+                        base_key = bytes.fromhex(base_hash)
+                    f_obj.write(data)
+                    pack_hash.update(data)
+                    idx_entries.append((bytes.fromhex(git_hash), offset, len(data), base_key))
+                    offset += len(data)
+        except:
+            os.remove(tmp_file_path)
+            raise
+        idx_entries.sort()
+        pack_name = "pack-" + pack_hash.hexdigest()
+        os.replace(tmp_file_path, cls.get_pack_path(pack_name))
+        idx_entry = cls._IDX_ENTRIES[cls._IDX_MAGIC]
+        idx_bytes = cls._IDX_HDR.pack(cls._IDX_MAGIC, cls._PACK_FORMATS.index(blob_format), len(idx_entries))
+        idx_bytes += b"".join(idx_entry.pack(*entry) for entry in idx_entries)
+        _write_file_atomically(cls.get_idx_path(pack_name), idx_bytes)
+        return pack_name
+    @classmethod
+    def remove(cls, pack_name):
+        # NB: remove the index first so that the pack is never visible without its data
+        os.remove(cls.get_idx_path(pack_name))
+        os.remove(cls.get_pack_path(pack_name))
+
 _SUB_DIR = None
 
 class Failure(object):
@@ -222,12 +535,11 @@ class _DataBaseData(SupervisedDictFactory):
         "selected_guards" : set,
         "patch_series_data" : list,
         "applied_patches_data" : list,
-        "combined_patch_data" : dict,
         "kept_patches" :dict
     }
-    MAY_BE_NONE = frozenset(["combined_patch_data"])
+    MAY_BE_NONE = frozenset()
     REQUIRED = frozenset()
-    DEFAULT_NONE = frozenset(["combined_patch_data"])
+    DEFAULT_NONE = frozenset()
 
 class _PatchData(SupervisedDictFactory):
     ALLOWED_ITEMS = {
@@ -242,14 +554,23 @@ class _PatchData(SupervisedDictFactory):
     DEFAULT_NONE = frozenset()
 
     @staticmethod
-    def decrement_ref_counts(patch_data, blob_ref_counts):
+    def blob_hashes(patch_data):
+        """Generate the hashes of the blobs referenced by the patch (one per reference)"""
         for pfd in patch_data["files_data"].values():
             if pfd["orig"] is not None:
-                blob_ref_counts[pfd["orig"]["git_hash"][:2]][pfd["orig"]["git_hash"][2:]] -= 1
+                yield pfd["orig"]["git_hash"]
             if pfd["darned"] is not None:
-                blob_ref_counts[pfd["darned"]["git_hash"][:2]][pfd["darned"]["git_hash"][2:]] -= 1
+                yield pfd["darned"]["git_hash"]
             if pfd["came_from"] is not None:
-                blob_ref_counts[pfd["came_from"]["orig"]["git_hash"][:2]][pfd["came_from"]["orig"]["git_hash"][2:]] -= 1
+                yield pfd["came_from"]["orig"]["git_hash"]
+
+    @staticmethod
+    def file_paths(patch_data):
+        """The paths of the patch's files (without loading them if possible)"""
+        try:
+            return patch_data.file_paths
+        except AttributeError:
+            return patch_data["files_data"].keys()
 
     @staticmethod
     def clear(patch_data, database):
@@ -258,17 +579,6 @@ class _PatchData(SupervisedDictFactory):
         patch_data["files_data"].clear()
         patch_data.clear()
 
-class _CombinedPatchData(SupervisedDictFactory):
-    ALLOWED_ITEMS = {"files_data" : dict, "prev" : dict}
-    MAY_BE_NONE = frozenset(["prev"])
-    REQUIRED = frozenset(["files_data", "prev"])
-    DEFAULT_NONE = frozenset(["prev"])
-
-    @classmethod
-    def make_new_dict(cls, prev=None):
-        files_data = dict() if not prev else {file_path : copy.copy(file_data) for file_path, file_data in prev["files_data"].items()}
-        return cls.new_dict(files_data=files_data, prev=prev)
-
 class _DiffData(SupervisedDictFactory):
     """Factory to create/manage persistent diff data in dictionaries"""
     ALLOWED_ITEMS = {"diff_type" : str, "diff_lines" : list}
@@ -308,7 +618,7 @@ class _FileData(SupervisedDictFactory):
         f_data.clear()
 
 class _CombinedFileData(SupervisedDictFactory):
-    """Factory to create/manage essential file data for combined patches in dictionaries"""
+    """Factory to create essential file data for combined patches in dictionaries"""
     ALLOWED_ITEMS = {"top" : dict, "bottom" : dict }
     MAY_BE_NONE = frozenset(["top", "bottom"])
 
@@ -363,17 +673,7 @@ class DarnItPatchOverlapsChanges(DarnItPatchError): pass
 class DarnItFileError(DarnIt): pass
 class DarnItFileHasUnresolvedMerges(DarnItFileError): pass
 
-def _find_named_patch_in_list(patch_list, patch_name):
-    for index, patch in enumerate(patch_list):
-        if patch["name"] == patch_name:
-            return (index, patch)
-    return (None, None)
-
-def _named_patch_is_in_list(patch_list, patch_name):
-    for patch in patch_list:
-        if patch["name"] == patch_name:
-            return True
-    return False
+class DarnItBadBlobPack(DarnIt): pass
 
 def _guards_block_patch(guards, patch):
     if guards:
@@ -420,7 +720,132 @@ def generate_diff_preamble(file_path, before, after, came_from=None):
     return diff_preamble.GitPreamble.generate_preamble(file_path, rodw(before), rodw(after), rodw(came_from))
 
 
-_DiffCreationData = collections.namedtuple("_DiffCreationData", ["label", "efd", "content", "timestamp"])
+_EMPTY_BLOB_GIT_HASH = "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"
+
+_STREAM_CHUNK_SIZE = 1024 * 1024
+
+def _read_file(file_path):
+    with open(file_path, "rb") as f_obj:
+        return f_obj.read()
+
+def _get_git_hash_for_file(file_path):
+    """Return the file's git hash (reading it in chunks so that memory
+    use doesn't depend on the file's size)
+    """
+    with open(file_path, "rb") as f_obj:
+        git_hash = hashlib.sha1(b"blob %d\0" % os.fstat(f_obj.fileno()).st_size)
+        for chunk in iter(functools.partial(f_obj.read, _STREAM_CHUNK_SIZE), b""):
+            git_hash.update(chunk)
+    return git_hash.hexdigest()
+
+def _write_compressed_blob_for_file(file_path, blob_file_path):
+    """Write the file's content to "blob_file_path" as a zlib blob and
+    return the git hash of the content that was written (reading it in
+    chunks so that memory use doesn't depend on the file's size)
+    """
+    with open(file_path, "rb") as f_obj, open(blob_file_path, "wb") as blob_f_obj:
+        header = b"blob %d\0" % os.fstat(f_obj.fileno()).st_size
+        git_hash = hashlib.sha1(header)
+        compressor = zlib.compressobj()
+        blob_f_obj.write(compressor.compress(header))
+        for chunk in iter(functools.partial(f_obj.read, _STREAM_CHUNK_SIZE), b""):
+            git_hash.update(chunk)
+            blob_f_obj.write(compressor.compress(chunk))
+        blob_f_obj.write(compressor.flush())
+    return git_hash.hexdigest()
+
+class _DiffCreationData(object):
+    """Data for one side of a diff.  The content may be supplied as a
+    function so that it's only read if it turns out to be needed (and
+    can be released once it has been used).  If the content is that of
+    a working file rather than a stored blob, "file_path" is its path.
+    """
+    __slots__ = ("label", "efd", "timestamp", "file_path", "_content", "_get_content", "_is_binary")
+    def __init__(self, label, efd, content, timestamp, file_path=None):
+        self.label = label
+        self.efd = efd
+        self.timestamp = timestamp
+        self.file_path = file_path
+        self._get_content = content if callable(content) else None
+        self._content = None if callable(content) else content
+        self._is_binary = None
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self._get_content()
+        return self._content
+    def release_content(self):
+        """Forget the content (if it can be read again when needed)"""
+        if self._get_content is not None:
+            self._content = None
+    @property
+    def git_hash(self):
+        return _EMPTY_BLOB_GIT_HASH if self.efd is None else self.efd["git_hash"]
+    @property
+    def is_binary(self):
+        if self._is_binary is None:
+            self._is_binary = self.content.find(b"\000") != -1
+        return self._is_binary
+    def get_job_data(self):
+        """Return the (label, timestamp, content, file path, git hash)
+        that a worker process needs to get the content for itself
+        """
+        if self._get_content is None:
+            return (self.label, self.timestamp, self._content, None, None)
+        return (self.label, self.timestamp, None, self.file_path, None if self.file_path else self.git_hash)
+
+def _diff_sides_differ(before, after):
+    # NB: the hashes identify the contents so there's no need to read them
+    return before.git_hash != after.git_hash
+
+def _get_diff_engine():
+    """Return the configured diff engine (or "difflib" if it's unknown)"""
+    engine = options.get("diff", "engine")
+    if engine not in diff_engines.ENGINES:
+        RCTX.stderr.write(_("Warning: unknown diff engine \"{0}\": using \"difflib\" instead.\n").format(engine))
+        return "difflib"
+    return engine
+
+def _generate_unified_diff_lines(before, after, engine):
+    if engine == "difflib":
+        return unified_diff.generate_diff_lines(before, after)
+    return diff_engines.generate_diff_lines(before, after, engine)
+
+def _generate_diff(before, after, engine):
+    """Return the diff data (type and lines) for the before and after data"""
+    if before.is_binary or after.is_binary:
+        return _DiffData.new_dict(diff_type="binary", diff_lines=list(git_binary_diff.generate_diff_lines(before, after)))
+    return _DiffData.new_dict(diff_type="unified", diff_lines=list(_generate_unified_diff_lines(before, after, engine)))
+
+def _generate_diff_lines(before, after, engine):
+    return _generate_diff(before, after, engine)["diff_lines"]
+
+def _generate_diffs_job(blob_format, engine, sides_job_data):
+    """Generate the diffs for a batch of (before, after) pairs in a
+    worker process.  The sides are passed as their job data so that
+    each side's content is read here (and only while it's needed)
+    rather than being sent from the parent.
+    """
+    blob_packs = [_BlobPack(pack_name) for pack_name in _BlobPack.get_pack_names()]
+    def make_side(label, timestamp, content, file_path, git_hash):
+        if file_path is not None:
+            content = functools.partial(_read_file, file_path)
+        elif content is None:
+            content = functools.partial(_read_stored_blob, git_hash, blob_format, lambda: blob_packs)
+        return _DiffCreationData(label, None, content, timestamp, file_path)
+    try:
+        return [_generate_diff(make_side(*before), make_side(*after), engine) for before, after in sides_job_data]
+    finally:
+        for blob_pack in blob_packs:
+            blob_pack.close()
+
+# Diffs are only generated in parallel if there are enough of them and
+# are then handed to the worker processes in batches.  As the workers
+# read the contents themselves a batch costs little to submit so they
+# are kept small to spread a few large files across the workers rather
+# than leaving them all to one of them.
+_PARALLEL_DIFF_MIN_FILES = 16
+_PARALLEL_DIFF_BATCH_SIZE = 8
 
 def git_hashes_differ(efd1, efd2):
     if efd1 is None:
@@ -442,9 +867,10 @@ class FileDiffMixin(object):
             efd = self["orig"]
             label = os.path.join("a", self.path) if efd else "/dev/null"
         timestamp = _EssentialFileData.timestamp(efd) if (with_timestamps and efd) else ""
-        content = b"" if as_refreshed else self.patch.database.get_content_for(efd)
+        content = b"" if as_refreshed else functools.partial(self.patch.database.get_content_for, efd)
         return _DiffCreationData(label, efd, content, timestamp)
     def get_diff_after_data(self, as_refreshed=False, with_timestamps=False):
+        file_path = None
         if as_refreshed or not self.patch.is_applied:
             efd = self["darned"]
             label = os.path.join("b", self.path) if efd else "/dev/null"
@@ -453,17 +879,27 @@ class FileDiffMixin(object):
             overlapping_file = self.get_overlapping_file()
             if overlapping_file is not None:
                 efd = overlapping_file["orig"]
-                content = self.patch.database.get_content_for(efd)
+                content = functools.partial(self.patch.database.get_content_for, efd)
             elif os.path.exists(self.path):
-                with open(self.path, "rb") as f_obj:
-                    content = f_obj.read()
-                efd = _EssentialFileData.new_dict(git_hash=utils.get_git_hash_for_content(content), lstats=os.lstat(self.path))
+                lstats = os.lstat(self.path)
+                efd = _EssentialFileData.new_dict(git_hash=self.patch.database.get_git_hash_for_file(self.path, lstats), lstats=lstats)
+                content = functools.partial(_read_file, self.path)
+                file_path = self.path
             else:
                 efd = None
                 content = b""
             label = os.path.join("b", self.path) if efd else "/dev/null"
         timestamp = _EssentialFileData.timestamp(efd) if (with_timestamps and efd) else ""
-        return _DiffCreationData(label, efd, content, timestamp)
+        return _DiffCreationData(label, efd, content, timestamp, file_path)
+    def get_diff_sides_to_generate(self, with_timestamps=False):
+        """Return the before and after data if the file's current diff
+        would have to be generated (i.e. it's not the stored diff)
+        """
+        before = self.get_diff_before_data(with_timestamps=with_timestamps)
+        after = self.get_diff_after_data(with_timestamps=with_timestamps)
+        if not isinstance(self, CombinedFileData) and after.efd and self["darned"] and after.efd["git_hash"] == self["darned"]["git_hash"]:
+            return None
+        return (before, after) if _diff_sides_differ(before, after) else None
     def get_diff_plus(self, as_refreshed=False, with_timestamps=False):
         assert as_refreshed is False or not isinstance(self, CombinedFileData)
         before = self.get_diff_before_data(as_refreshed=as_refreshed, with_timestamps=with_timestamps)
@@ -473,12 +909,11 @@ class FileDiffMixin(object):
             as_refreshed = after.efd and self["darned"] and after.efd["git_hash"] == self["darned"]["git_hash"]
         if as_refreshed:
             diff = diffs.diff_parse_lines(self["diff"]["diff_lines"]) if self["diff"] else None
-        elif before.content == after.content:
+        elif not _diff_sides_differ(before, after):
             diff = None
-        elif before.content.find(b"\000") != -1 or after.content.find(b"\000") != -1:
-            diff = git_binary_diff.GitBinaryDiff.generate_diff(before, after)
         else:
-            diff = unified_diff.generate_diff(before, after)
+            diff_lines = self.patch.database.get_diff_lines(before, after)
+            diff = diffs.diff_parse_lines(diff_lines) if diff_lines else None
         diff_plus = patches.DiffPlus([preamble], diff)
         if self["renamed_as"] and after.efd is None:
             diff_plus.trailing_junk.append(_("# Renamed to: {0}\n").format(self["renamed_as"]))
@@ -492,12 +927,10 @@ class FileDiffMixin(object):
             as_refreshed = after.efd and self["darned"] and after.efd["git_hash"] == self["darned"]["git_hash"]
         if as_refreshed:
             diff = "" if self["diff"] is None else "".join(self["diff"]["diff_lines"])
-        elif before.content == after.content:
+        elif not _diff_sides_differ(before, after):
             diff = ""
-        elif before.content.find(b"\000") != -1 or after.content.find(b"\000") != -1:
-            diff = "".join(git_binary_diff.generate_diff_lines(before, after))
         else:
-            diff = "".join(unified_diff.generate_diff_lines(before, after))
+            diff = "".join(self.patch.database.get_diff_lines(before, after))
         trailing_junk = _("# Renamed to: {0}\n").format(self["renamed_as"]) if self["renamed_as"] and after.efd is None else ""
         return preamble + (diff if diff else "") + trailing_junk
 
@@ -508,6 +941,9 @@ class FileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
         self.path = file_path
         self.persistent_file_data = persistent_file_data
         self.patch = patch
+    def __setitem__(self, key, value):
+        mixins.PedanticDictProxyMixin.__setitem__(self, key, value)
+        self.patch.mark_as_changed()
     def __lt__(self, other):
         return self.path < other.path
     def __gt__(self, other):
@@ -534,7 +970,7 @@ class FileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
         orig = patch.database.store_file_content(file_path)
         came_from = patch.create_came_from_for_copy(came_from_path)
         try:
-            shutil.copy2(came_from_path, file_path)
+            _copy_file(came_from_path, file_path)
         except OSError:
             patch.database.release_stored_content(orig)
             if came_from:
@@ -550,7 +986,7 @@ class FileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
     def copy_contents_from(self, copy_from_path):
         new_came_from = self.patch.create_came_from_for_copy(copy_from_path)
         try:
-            shutil.copy2(copy_from_path, self.path)
+            _copy_file(copy_from_path, self.path)
         except OSError:
             if new_came_from:
                 self.patch.database.release_stored_content(new_came_from["orig"])
@@ -700,11 +1136,11 @@ class FileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
                     return True
                 elif self["darned"]["lstats"].st_size != lstats.st_size:
                     return True
-                elif self["darned"]["lstats"].st_mtime != lstats.st_mtime:
-                    # NB: using modify time and size instead of comparing hash values
-                    # but since change modification times doesn't mean contents changed
-                    # we will check (this is expensive but good for the UIX)
-                    return self["darned"]["git_hash"] != utils.get_git_hash_for_file(self.path)
+                else:
+                    # NB: the stat cache means that the file is only read if its
+                    # stat data has changed and (unlike comparing modify times)
+                    # catches changes made within the timestamps' granularity
+                    return self["darned"]["git_hash"] != self.patch.database.get_git_hash_for_file(self.path, lstats)
             else:
                 return os.path.exists(self.path)
         else:
@@ -744,16 +1180,16 @@ class FileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
         return self.patch.get_overlapping_file(self.path)
     def _get_before_content_path(self):
         if self["came_from"]:
-            return get_blob_path(self["came_from"]["orig"]["git_hash"])
+            return self.patch.database.get_blob_file_path(self["came_from"]["orig"]["git_hash"])
         elif self["orig"]:
-            return get_blob_path(self["orig"]["git_hash"])
+            return self.patch.database.get_blob_file_path(self["orig"]["git_hash"])
         else:
             return "/dev/null"
     def get_reconciliation_paths(self):
         assert self.patch.is_top_patch
         # make it hard for the user to (accidentally) create these files if they don't exist
         before_path = self._get_before_content_path()
-        stashed_path = get_blob_path(self["darned"]["git_hash"]) if self["darned"] else "/dev/null"
+        stashed_path = self.patch.database.get_blob_file_path(self["darned"]["git_hash"]) if self["darned"] else "/dev/null"
         # The user has to be able to cope with the main file not existing (meld can)
         return _O_IP_S_TRIPLET(before_path, self.path, stashed_path)
     def get_extdiff_paths(self):
@@ -769,18 +1205,21 @@ class FileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
     def get_refresh_after_data(self, overlapping_file, with_timestamps=False):
         if overlapping_file is not None:
             efd = self.patch.database.clone_stored_content_data(overlapping_file["orig"])
-            content = self.patch.database.get_content_for(efd)
+            content = functools.partial(self.patch.database.get_content_for, efd)
         elif os.path.exists(self.path):
-            with open(self.path, "rb") as f_obj:
-                content = f_obj.read()
-            efd = _EssentialFileData.new_dict(git_hash=self.patch.database.store_content(content), lstats=os.lstat(self.path))
+            lstats = os.lstat(self.path)
+            efd = _EssentialFileData.new_dict(git_hash=self.patch.database.store_file(self.path, lstats), lstats=lstats)
+            content = functools.partial(self.patch.database.get_content_for, efd)
         else:
             efd = None
             content = b""
         label = os.path.join("b", self.path) if efd else "/dev/null"
         timestamp = _EssentialFileData.timestamp(efd) if (with_timestamps and efd) else ""
         return _DiffCreationData(label, efd, content, timestamp)
-    def do_refresh(self, stdout=None, with_timestamps=False):
+    def get_refresh_sides(self, with_timestamps=False):
+        """Return the before and after data for refreshing the file
+        (storing the after content)
+        """
         assert self.patch.is_applied
         # pylint: disable=attribute-defined-outside-init
         overlapping_file = self.get_overlapping_file()
@@ -789,12 +1228,14 @@ class FileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
             raise DarnItFileHasUnresolvedMerges(file_path=self.path)
         before = self.get_diff_before_data(as_refreshed=False, with_timestamps=with_timestamps)
         after = self.get_refresh_after_data(overlapping_file, with_timestamps=with_timestamps)
-        if before.content == after.content:
-            self["diff"] = None
-        elif before.content.find(b"\000") != -1 or after.content.find(b"\000") != -1:
-            self["diff"] = _DiffData.new_dict(diff_type="binary", diff_lines=git_binary_diff.generate_diff_lines(before, after))
-        else:
-            self["diff"] = _DiffData.new_dict(diff_type="unified", diff_lines=unified_diff.generate_diff_lines(before, after))
+        return (before, after)
+    def do_refresh(self, stdout=None, with_timestamps=False):
+        before, after = self.get_refresh_sides(with_timestamps=with_timestamps)
+        diff = _generate_diff(before, after, self.patch.database.diff_engine) if _diff_sides_differ(before, after) else None
+        self.finish_refresh(before, after, diff, stdout=stdout)
+    def finish_refresh(self, before, after, diff, stdout=None):
+        # pylint: disable=attribute-defined-outside-init
+        self["diff"] = diff
         self.patch.database.release_stored_content(self["darned"])
         self["darned"] = after.efd
         self["diff_wrt"] = before.efd
@@ -803,6 +1244,19 @@ class FileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
                 stdout.write(_("\"{0}\": file does not exist\n").format(rel_subdir(self.path)))
             elif before.efd and after.efd and after.efd["lstats"].st_mode != before.efd["lstats"].st_mode:
                 stdout.write(_("\"{0}\": mode {1:07o} -> {2:07o}.\n").format(rel_subdir(self.path), before.efd["lstats"].st_mode, after.efd["lstats"].st_mode))
+    def _diff_wrt_is_current(self, drop_atws):
+        """Is the file's current content the content that the diff was
+        made against (so that the result of applying it is "darned")?
+        """
+        if self["diff_wrt"] == dict() or os.path.islink(self.path): # NB: Empty dictionary means associated diff is STALE
+            return False
+        if drop_atws and _DiffData.report_trailing_whitespace(self["diff"]):
+            # the added trailing white space will be removed as the diff is applied
+            return False
+        wrt_git_hash = self["diff_wrt"]["git_hash"] if self["diff_wrt"] else None
+        if os.path.exists(self.path):
+            return self.patch.database.get_git_hash_for_file(self.path) == wrt_git_hash
+        return wrt_git_hash is None
     def apply_diff(self, drop_atws=True):
         # we assume that "orig" data is correct
         current_efd = self["came_from"]["orig"] if self["came_from"] else self["orig"]
@@ -811,8 +1265,7 @@ class FileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
         if self["diff"]:
             if self["diff"]["diff_type"] == "binary":
                 if self["darned"] is not None:
-                    with open(self.path, "wb") as f_obj:
-                        f_obj.write(self.patch.database.get_content_for(self["darned"]))
+                    self.patch.database.restore_content_to_file(self["darned"], self.path, self.patch.database.get_restore_mtime("push"))
                     if already_exists:
                         RCTX.stdout.write(_("\"{0}\": binary file replaced.\n").format(rel_subdir(self.path)))
                     else:
@@ -824,7 +1277,14 @@ class FileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
                     retval = CmdResult.WARNING
                     RCTX.stderr.write(_("Warning: \"{0}\": binary file's original has changed.\n").format(rel_subdir(self.path)))
             else:
-                retval = unified_diff.parse_diff_lines(self["diff"]["diff_lines"]).apply_to_file(self.path, rel_subdir(self.path), drop_atws=drop_atws)
+                if self._diff_wrt_is_current(drop_atws):
+                    # NB: applying the diff would just reproduce the "darned" content
+                    if self["darned"] is None:
+                        os.remove(self.path)
+                    else:
+                        self.patch.database.restore_content_to_file(self["darned"], self.path, self.patch.database.get_restore_mtime("push"))
+                else:
+                    retval = unified_diff.parse_diff_lines(self["diff"]["diff_lines"]).apply_to_file(self.path, rel_subdir(self.path), drop_atws=drop_atws)
                 if os.path.exists(self.path):
                     if self["came_from"]:
                         if self["came_from"]["as_rename"]:
@@ -915,7 +1375,7 @@ class CombinedFileData(mixins.PedanticDictProxyMixin, FileDiffMixin):
                 # NB: using modify time and size instead of comparing hash values
                 # but since change modification times doesn't mean contents changed
                 # we will check (this is expensive but good for the UIX)
-                return self["top"]["darned"]["git_hash"] != utils.get_git_hash_for_file(self.path)
+                return self["top"]["darned"]["git_hash"] != self.patch.database.get_git_hash_for_file(self.path, lstats)
             else:
                 return False
         else:
@@ -930,13 +1390,18 @@ class Patch(mixins.PedanticDictProxyMixin):
     def __init__(self, patch_data, database):
         self.persistent_patch_data = patch_data
         self.database = database
-        assert patch_data in database["patch_series_data"]
+        assert database.is_series_patch_data(patch_data)
+    def __setitem__(self, key, value):
+        mixins.PedanticDictProxyMixin.__setitem__(self, key, value)
+        self.mark_as_changed()
+    def mark_as_changed(self):
+        self.database.mark_patch_data_as_changed(self.persistent_patch_data)
     def __eq__(self, other):
+        # NB: patches are identified by their persistent data objects
         try:
-            return self.persistent_patch_data == other.persistent_patch_data
+            return self.persistent_patch_data is other.persistent_patch_data
         except AttributeError:
-            assert other is None or _PatchData.verify_dict(other)
-            return self.persistent_patch_data == other
+            return self.persistent_patch_data is other
     @property
     def name(self):
         return self["name"]
@@ -945,13 +1410,14 @@ class Patch(mixins.PedanticDictProxyMixin):
         return self["description"]
     @property
     def is_applied(self):
-        return self.persistent_patch_data in self.database["applied_patches_data"]
+        return self.database.get_applied_depth(self.persistent_patch_data) is not None
     @property
     def is_blocked_by_guard(self):
         return _guards_block_patch(self.database["selected_guards"], self.persistent_patch_data)
     @property
     def is_top_patch(self):
-        return self.persistent_patch_data == self.database.top_patch.persistent_patch_data
+        applied_patches_data = self.database["applied_patches_data"]
+        return bool(applied_patches_data) and self.persistent_patch_data is applied_patches_data[-1]
     @property
     def needs_refresh(self):
         if not self.is_applied:
@@ -983,24 +1449,24 @@ class Patch(mixins.PedanticDictProxyMixin):
         else:
             return (FileData(file_path, pfd, self) for file_path, pfd in sorted(self["files_data"].items()) if file_path in file_paths)
     def iterate_overlying_patches(self):
-        applied_index = self.database["applied_patches_data"].index(self.persistent_patch_data)
+        applied_index = self.database.get_applied_depth(self.persistent_patch_data)
         return self.database.iterate_applied_patches(start=applied_index + 1)
     def get_file(self, file_path):
         return FileData(file_path, self["files_data"][file_path], self)
     def has_file_with_path(self, file_path):
-        return file_path in self["files_data"]
+        return file_path in _PatchData.file_paths(self.persistent_patch_data)
     def get_file_paths_set(self, file_paths=None):
         if file_paths is None:
-            return set(self["files_data"].keys())
+            return set(_PatchData.file_paths(self.persistent_patch_data))
         else:
-            return {file_path for file_path in self["files_data"].keys() if file_path in file_paths}
+            return {file_path for file_path in _PatchData.file_paths(self.persistent_patch_data) if file_path in file_paths}
     def get_files_table(self):
         return [patch_file.get_table_row() for patch_file in self.iterate_files()]
     def get_overlapping_file(self, file_path):
-        for patch in self.iterate_overlying_patches():
-            file_data = patch["files_data"].get(file_path, None)
-            if file_data:
-                return FileData(file_path, file_data, patch)
+        applied_depth = self.database.get_applied_depth(self.persistent_patch_data)
+        for patch_data in self.database.get_applied_patches_data_for_file(file_path):
+            if self.database.get_applied_depth(patch_data) > applied_depth:
+                return FileData(file_path, patch_data["files_data"][file_path], Patch(patch_data, self.database))
         return None
     def get_table_row(self):
         return PatchTableRow(self["name"], self.state, self["pos_guards"], self["neg_guards"])
@@ -1040,7 +1506,6 @@ class Patch(mixins.PedanticDictProxyMixin):
                 creates.append(file_data)
             else:
                 others.append(file_data)
-            self.database.combined_patch.add_file(file_data)
         biggest_ecode = CmdResult.OK
         # Next do the files that are created by this patch as they may have been copied
         for file_data in creates:
@@ -1052,7 +1517,7 @@ class Patch(mixins.PedanticDictProxyMixin):
                 RCTX.stderr.write(_("{0}: failed to copy {1}.\n").format(rel_subdir(file_data.path), rel_subdir(file_data["came_from"]["file_path"])))
             else:
                 try:
-                    shutil.copy2(file_data["came_from"]["file_path"], file_data.path)
+                    _copy_file(file_data["came_from"]["file_path"], file_data.path)
                 except OSError as edata:
                     biggest_ecode = CmdResult.ERROR
                     RCTX.stderr.write(edata)
@@ -1064,8 +1529,7 @@ class Patch(mixins.PedanticDictProxyMixin):
             fm_file_data = self.get_file(file_data["came_from"]["file_path"])
             # TODO: investigate whether fm_file_data["orig"] can be None here. Duplicated patch?
             try:
-                with open(file_data.path, "wb") as f_obj:
-                    f_obj.write(self.database.get_content_for(fm_file_data["orig"]))
+                self.database.write_content_to_file(fm_file_data["orig"], file_data.path)
                 os.chmod(file_data.path, _EssentialFileData.permissions(fm_file_data["orig"]))
             except (OSError, IOError) as edata:
                 biggest_ecode = CmdResult.ERROR
@@ -1079,42 +1543,37 @@ class Patch(mixins.PedanticDictProxyMixin):
             biggest_ecode = max(biggest_ecode, file_data.apply_diff(drop_atws))
         return biggest_ecode
     def undo_apply(self):
+        restore_mtime = self.database.get_restore_mtime("pop")
         for file_path, file_data in self["files_data"].items():
             if file_data["orig"] is None:
                 if os.path.exists(file_path):
                     os.remove(file_path)
                 continue
-            dir_path = os.path.dirname(file_path)
-            if dir_path and not os.path.exists(dir_path):
-                os.makedirs(dir_path)
             # TODO: add special handling for restoring deleted soft links on pop
             # TODO: use move to put back renamed files
-            orig_content = self.database.get_content_for(file_data["orig"])
-            with open(file_path, "wb") as f_obj:
-                f_obj.write(orig_content)
-            os.chmod(file_path, _EssentialFileData.permissions(file_data["orig"]))
+            self.database.restore_content_to_file(file_data["orig"], file_path, restore_mtime)
     def add_file(self, file_data):
         assert not self.is_applied or self.is_top_patch
         assert file_data.path not in self["files_data"]
         self["files_data"][file_data.path] = file_data.persistent_file_data
+        self.mark_as_changed()
         if self.is_applied:
-            self.database.combined_patch.add_file(file_data)
+            self.database.note_file_added_to_top_patch(file_data.path)
     def clear(self):
         return _PatchData.clear(self.persistent_patch_data, self.database)
     def drop_file(self, file_data):
         assert not self.is_applied or self.is_top_patch
         if self.is_applied:
-            self.database.combined_patch.drop_file(file_data)
+            self.database.note_file_dropped_from_top_patch(file_data.path)
             if file_data["orig"]:
-                with open(file_data.path, "wb") as f_obj:
-                    f_obj.write(self.database.get_content_for(file_data["orig"]))
-                os.chmod(file_data.path, _EssentialFileData.permissions(file_data["orig"]))
+                self.database.restore_content_to_file(file_data["orig"], file_data.path, self.database.get_restore_mtime("pop"))
             elif os.path.exists(file_data.path):
                 os.remove(file_data.path)
         # if this file was the result of a rename then we make the original a normal file
         if file_data["came_from"] and file_data["came_from"]["as_rename"]:
             self.get_file(file_data["came_from"]["file_path"])["renamed_as"] = None
         del self["files_data"][file_data.path]
+        self.mark_as_changed()
         # if this file had been renamed then the renamed version becomes a copy
         if file_data["renamed_as"]:
             self.get_file(file_data["renamed_as"])["came_from"]["as_rename"] = False
@@ -1122,14 +1581,46 @@ class Patch(mixins.PedanticDictProxyMixin):
         file_data.release_contents()
     def drop_named_file(self, file_path):
         self.drop_file(self.get_file(file_path))
-    def do_refresh(self, stdout=None):
+    def prepare_refresh(self):
+        """Work out the before and after data (storing the after
+        content) for those of the patch's files that need refreshing.
+        Return the outcome, those files' (file data, before, after)
+        triples and the number of unchanged files skipped.
+        """
         eflag = CmdResult.OK
+        refreshes = []
+        skipped = 0
         for file_data in self.iterate_files_sorted():
+            # NB: refreshing an unchanged file would just reproduce its diff
+            if not file_data.needs_refresh:
+                skipped += 1
+                continue
             try:
-                file_data.do_refresh(stdout=stdout)
+                before, after = file_data.get_refresh_sides()
             except DarnItFileHasUnresolvedMerges:
                 RCTX.stderr.write(_("\"{0}\": file has unresolved merge(s).\n").format(rel_subdir(file_data.path)))
                 eflag = CmdResult.ERROR
+                continue
+            refreshes.append((file_data, before, after))
+        return (eflag, refreshes, skipped)
+    @staticmethod
+    def get_refresh_sides_to_diff(refreshes):
+        return [(before, after) for _file_data, before, after in refreshes if _diff_sides_differ(before, after)]
+    @staticmethod
+    def finish_refresh(refreshes, skipped, diffs, stdout=None):
+        """Record the refreshes' results taking the diffs (in order)
+        from the "diffs" iterator
+        """
+        for file_data, before, after in refreshes:
+            diff = next(diffs) if _diff_sides_differ(before, after) else None
+            file_data.finish_refresh(before, after, diff, stdout=stdout)
+        if stdout:
+            stdout.write(_("{0} file(s) refreshed, {1} unchanged file(s) skipped.\n").format(len(refreshes), skipped))
+    def do_refresh(self, stdout=None):
+        eflag, refreshes, skipped = self.prepare_refresh()
+        # NB: the diffs are generated together so that it can be done in parallel
+        diffs = iter(self.database.generate_diffs(self.get_refresh_sides_to_diff(refreshes)))
+        self.finish_refresh(refreshes, skipped, diffs, stdout=stdout)
         return eflag
     def do_rename_file(self, file_path, new_file_path):
         assert os.path.exists(file_path)
@@ -1344,69 +1835,176 @@ class TextPatch(patches.Patch):
         h.update(str(self.state).encode())
         return h.digest()
 
-class CombinedPatch(mixins.PedanticDictProxyMixin):
-    PROXIED_ITEMS = _CombinedPatchData.ALLOWED_ITEMS
-    PROXIED_DICT_NAME = "persistent_data"
+class CombinedPatch(object):
+    """The combined effect of the applied patches.  This is computed on
+    demand from the database's index of the applied patches containing
+    each file (whose bottom and top patches provide the file's data)
+    rather than being stored.
+    """
     is_applied = True
-    def __init__(self, persistent_data, database):
-        self.persistent_data = persistent_data
+    def __init__(self, database):
         self.database = database
-    def add_file(self, file_data):
-        if self["prev"]:
-            prev_file_data = self["prev"]["files_data"].get(file_data.path, None)
-            bottom = prev_file_data["bottom"] if prev_file_data else file_data.persistent_file_data
-        else:
-            bottom = file_data.persistent_file_data
-        self["files_data"][file_data.path] = _CombinedFileData.new_dict(top=file_data.persistent_file_data, bottom=bottom)
-    def drop_file(self, file_data):
-        assert self["files_data"][file_data.path]["top"] == file_data.persistent_file_data, "\n\t{}\n!=\n\t {}".format(self["files_data"][file_data.path]["top"], file_data.persistent_file_data)
-        prev_file_data = self["prev"]["files_data"].get(file_data.path, None) if self["prev"] else None
-        if prev_file_data:
-            self["files_data"][file_data.path] = copy.copy(prev_file_data)
-        else:
-            del self["files_data"][file_data.path]
+    def _get_combined_file_data(self, file_path):
+        applied_patches_data = self.database.get_applied_patches_data_for_file(file_path)
+        if not applied_patches_data:
+            raise KeyError(file_path)
+        return _CombinedFileData.new_dict(top=applied_patches_data[-1]["files_data"][file_path], bottom=applied_patches_data[0]["files_data"][file_path])
     def iterate_files_sorted(self, file_paths=None):
         if file_paths is None:
-            return (CombinedFileData(file_path, pfd, self) for file_path, pfd in sorted(self["files_data"].items()))
+            return (self.get_file(file_path) for file_path in sorted(self.database.get_applied_file_paths()))
         else:
-            return (CombinedFileData(file_path, pfd, self) for file_path, pfd in sorted(self["files_data"].items()) if file_path in file_paths)
+            return (self.get_file(file_path) for file_path in sorted(self.database.get_applied_file_paths()) if file_path in file_paths)
     def get_files_table(self):
         return [file_data.get_table_row() for file_data in self.iterate_files_sorted() if not file_data.was_ephemeral]
     def get_file(self, file_path):
-        return CombinedFileData(file_path, self["files_data"][file_path], self)
+        return CombinedFileData(file_path, self._get_combined_file_data(file_path), self)
     def has_file_with_path(self, file_path):
         try:
             return not self.get_file(file_path).was_ephemeral
         except KeyError:
             return False
     def get_text_diff(self, file_paths=None, with_timestamps=False):
-        text = ""
         if file_paths:
-            for file_path in file_paths:
-                text += self.get_file(file_path).get_diff_text(with_timestamps=with_timestamps)
+            files_data = [self.get_file(file_path) for file_path in file_paths]
         else:
-            for file_data in self.iterate_files_sorted():
-                if file_data.was_ephemeral:
-                    continue
-                text += file_data.get_diff_text(with_timestamps=with_timestamps)
-        return text
+            files_data = [file_data for file_data in self.iterate_files_sorted() if not file_data.was_ephemeral]
+        self.database.prefetch_diff_lines(files_data, with_timestamps=with_timestamps)
+        return "".join(file_data.get_diff_text(with_timestamps=with_timestamps) for file_data in files_data)
     def get_diff_pluses(self, file_paths=None, with_timestamps=False):
         if file_paths:
-            return [self.get_file(file_path).get_diff_plus(with_timestamps=with_timestamps) for file_path in file_paths]
+            files_data = [self.get_file(file_path) for file_path in file_paths]
         else:
-            return [file_data.get_diff_plus(with_timestamps=with_timestamps) for file_data in self.iterate_files_sorted()]
+            files_data = list(self.iterate_files_sorted())
+        self.database.prefetch_diff_lines(files_data, with_timestamps=with_timestamps)
+        return [file_data.get_diff_plus(with_timestamps=with_timestamps) for file_data in files_data]
 
 _ContentState = collections.namedtuple("_ContentState", ["orphans", "missing", "bad_content"])
 
+_SeriesIndex = collections.namedtuple("_SeriesIndex", ["positions", "applied_depths"])
+
+ContentCacheStats = collections.namedtuple("ContentCacheStats", ["hits", "misses", "count", "size"])
+
+class _ContentCache(object):
+    """A size bounded cache of blob contents (keyed by their git hashes)
+    that discards the least recently used contents when it's full.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+    def get(self, git_hash):
+        content = self._entries.get(git_hash, None)
+        if content is None:
+            self.misses += 1
+        else:
+            self._entries.move_to_end(git_hash)
+            self.hits += 1
+        return content
+    def put(self, git_hash, content):
+        if git_hash in self._entries or len(content) > self.max_size:
+            return
+        self._entries[git_hash] = content
+        self._size += len(content)
+        while self._size > self.max_size:
+            _git_hash, old_content = self._entries.popitem(last=False) # pylint: disable=unused-variable
+            self._size -= len(old_content)
+    def discard(self, git_hash):
+        content = self._entries.pop(git_hash, None)
+        if content is not None:
+            self._size -= len(content)
+    @property
+    def stats(self):
+        return ContentCacheStats(self.hits, self.misses, len(self._entries), self._size)
+
 class DataBase(mixins.PedanticDictProxyMixin):
     PROXIED_ITEMS = _DataBaseData.ALLOWED_ITEMS
     PROXIED_DICT_NAME = "_PPD"
+    CONTENT_CACHE_MAX_SIZE = 32 * 1024 * 1024
+    DIFF_CACHE_MAX_SIZE = 64 * 1024 * 1024
     def __init__(self, patches_persistent_data, blob_ref_counts, is_writable):
         self._PPD = patches_persistent_data
         self.blob_ref_counts = blob_ref_counts
         self.is_writable = is_writable
-        for patch in patches_persistent_data["applied_patches_data"]:
-            assert patch in patches_persistent_data["patch_series_data"]
+        self._series_changed = False
+        self._series_index = None
+        self._file_patch_stacks = None
+        self._changed_patches_data = dict()
+        self._orig_ref_counts = dict()
+        self.stat_cache = _StatCache()
+        self.diff_cache = _DiffCache(self.DIFF_CACHE_MAX_SIZE)
+        self.blob_format = _read_blob_format()
+        self._blob_packs = None
+        self._content_cache = _ContentCache(self.CONTENT_CACHE_MAX_SIZE)
+        self._diff_engine = None
+        # NB: "pop" and "push" options that have been overridden for this session
+        self.restore_mtime_overrides = dict()
+        for patch_data in patches_persistent_data["applied_patches_data"]:
+            assert self.is_series_patch_data(patch_data)
+    def _note_series_change(self):
+        self._series_changed = True
+        self._series_index = None
+    def _get_series_index(self):
+        # NB: this is rebuilt on demand after any change to the series
+        if self._series_index is None:
+            self._series_index = _SeriesIndex(
+                positions={patch_data["name"] : index for index, patch_data in enumerate(self._PPD["patch_series_data"])},
+                applied_depths={id(patch_data) : index for index, patch_data in enumerate(self._PPD["applied_patches_data"])},
+            )
+        return self._series_index
+    def get_series_position(self, patch_name):
+        """Return the named patch's position in the series (or None if not present)"""
+        return self._get_series_index().positions.get(patch_name, None)
+    def get_applied_depth(self, patch_data):
+        """Return the position of the patch in the applied patches (or None if not applied)"""
+        return self._get_series_index().applied_depths.get(id(patch_data), None)
+    def is_series_patch_data(self, patch_data):
+        position = self.get_series_position(patch_data["name"])
+        return position is not None and self._PPD["patch_series_data"][position] is patch_data
+    def _get_file_patch_stacks(self):
+        # NB: this is built from the patches' file paths on first use
+        # and then kept up to date as patches and files come and go
+        if self._file_patch_stacks is None:
+            self._file_patch_stacks = dict()
+            for patch_data in self._PPD["applied_patches_data"]:
+                for file_path in _PatchData.file_paths(patch_data):
+                    self._file_patch_stacks.setdefault(file_path, []).append(patch_data)
+        return self._file_patch_stacks
+    def get_applied_patches_data_for_file(self, file_path):
+        """Return the data for the applied patches (bottom first) that contain the file"""
+        return self._get_file_patch_stacks().get(file_path, [])
+    def get_applied_file_paths(self):
+        """Return the set of paths of files in applied patches"""
+        return set(self._get_file_patch_stacks().keys())
+    def note_file_added_to_top_patch(self, file_path):
+        if self._file_patch_stacks is not None:
+            self._file_patch_stacks.setdefault(file_path, []).append(self._PPD["applied_patches_data"][-1])
+    def note_file_dropped_from_top_patch(self, file_path):
+        if self._file_patch_stacks is not None:
+            stack = self._file_patch_stacks[file_path]
+            assert stack[-1] is self._PPD["applied_patches_data"][-1]
+            stack.pop()
+            if not stack:
+                del self._file_patch_stacks[file_path]
+    def _top_patch_series_position(self):
+        return self.get_series_position(self.top_patch_name) if self._PPD["applied_patches_data"] else None
+    def mark_patch_data_as_changed(self, patch_data):
+        self._changed_patches_data[id(patch_data)] = patch_data
+    @property
+    def changed_patches_data(self):
+        return list(self._changed_patches_data.values())
+    def _get_ref_count_for_hash(self, git_hash):
+        return self.blob_ref_counts.get(git_hash)
+    def _note_ref_count_for_hash(self, git_hash):
+        if git_hash not in self._orig_ref_counts:
+            self._orig_ref_counts[git_hash] = self._get_ref_count_for_hash(git_hash)
+    @property
+    def changed_blob_hashes(self):
+        return {git_hash for git_hash, count in self._orig_ref_counts.items() if self._get_ref_count_for_hash(git_hash) != count}
+    @property
+    def is_dirty(self):
+        return self._series_changed or bool(self._changed_patches_data) or bool(self.changed_blob_hashes)
     @property
     def top_patch(self):
         return None if not self._PPD["applied_patches_data"] else Patch(self._PPD["applied_patches_data"][-1], self)
@@ -1427,7 +2025,7 @@ class DataBase(mixins.PedanticDictProxyMixin):
         return None if len(self._PPD["applied_patches_data"]) < 2 else self._PPD["applied_patches_data"][-2]["name"]
     def _next_patch_data(self):
         if self._PPD["applied_patches_data"]:
-            top_patch_index = self._PPD["patch_series_data"].index(self._PPD["applied_patches_data"][-1])
+            top_patch_index = self._top_patch_series_position()
             for patch in self._PPD["patch_series_data"][top_patch_index + 1:]:
                 if not _guards_block_patch(self._PPD["selected_guards"], patch):
                     return patch
@@ -1449,7 +2047,7 @@ class DataBase(mixins.PedanticDictProxyMixin):
         return self._next_patch_data() is not None
     @property
     def combined_patch(self):
-        return CombinedPatch(self["combined_patch_data"], self) if self["combined_patch_data"] else None
+        return CombinedPatch(self) if self._PPD["applied_patches_data"] else None
     @property
     def patch_count(self):
         return len(self._PPD["patch_series_data"])
@@ -1458,29 +2056,29 @@ class DataBase(mixins.PedanticDictProxyMixin):
         return len(self._PPD["applied_patches_data"])
     def create_new_patch(self, patch_name, description):
         assert self.is_writable
-        if _named_patch_is_in_list(self._PPD["patch_series_data"], patch_name):
+        if self.has_patch_with_name(patch_name):
             raise DarnItPatchExists(patch_name=patch_name)
         new_patch = _PatchData.new_dict(name=patch_name, description=_tidy_text(description))
         if self._PPD["applied_patches_data"]:
-            top_patch_index = self._PPD["patch_series_data"].index(self._PPD["applied_patches_data"][-1])
+            top_patch_index = self._top_patch_series_position()
             self._PPD["patch_series_data"].insert(top_patch_index + 1, new_patch)
         else:
             self._PPD["patch_series_data"].insert(0, new_patch)
         self._PPD["applied_patches_data"].append(new_patch)
-        assert self._PPD["applied_patches_data"][-1] == new_patch
-        assert new_patch in self._PPD["patch_series_data"]
-        self._PPD["combined_patch_data"] = _CombinedPatchData.make_new_dict(self._PPD["combined_patch_data"])
+        self._note_series_change()
+        assert self.is_series_patch_data(new_patch) and self.top_patch_name == patch_name
         return Patch(new_patch, self)
     def duplicate_patch(self, patch, new_patch_name, new_description):
         assert self.is_writable
-        if _named_patch_is_in_list(self._PPD["patch_series_data"], new_patch_name):
+        if self.has_patch_with_name(new_patch_name):
             raise DarnItPatchExists(patch_name=new_patch_name)
         new_patch_data = _PatchData.new_dict(name=new_patch_name, description=_tidy_text(new_description))
         if self._PPD["applied_patches_data"]:
-            top_patch_index = self._PPD["patch_series_data"].index(self._PPD["applied_patches_data"][-1])
+            top_patch_index = self._top_patch_series_position()
             self._PPD["patch_series_data"].insert(top_patch_index + 1, new_patch_data)
         else:
             self._PPD["patch_series_data"].insert(0, new_patch_data)
+        self._note_series_change()
         new_patch = Patch(new_patch_data, self)
         for file_data in patch.iterate_files():
             new_patch.add_file(file_data.clone_for_patch(new_patch))
@@ -1494,13 +2092,15 @@ class DataBase(mixins.PedanticDictProxyMixin):
         assert self.is_writable
         if patch.is_applied:
             raise DarnItPatchIsApplied(patch_name=patch.name)
-        self["patch_series_data"].remove(patch)
+        self["patch_series_data"].remove(patch.persistent_patch_data)
+        self._note_series_change()
         if retain_copy:
             try:
                 _PatchData.clear(self["kept_patches"].pop(patch.name), self)
             except KeyError:
                 pass
             self["kept_patches"][patch.name] = patch.persistent_patch_data
+            patch.mark_as_changed()
         else:
             patch.clear()
     def remove_named_patch(self, patch_name, retain_copy=False):
@@ -1511,6 +2111,7 @@ class DataBase(mixins.PedanticDictProxyMixin):
             _PatchData.clear(self["kept_patches"].pop(patch_name), self)
         except KeyError:
             raise DarnItUnknownPatch(patch_name=patch_name)
+        self._note_series_change()
     def restore_named_patch(self, patch_name, as_patch_name=None):
         assert self.is_writable
         if not as_patch_name:
@@ -1523,16 +2124,18 @@ class DataBase(mixins.PedanticDictProxyMixin):
             raise DarnItUnknownPatch(patch_name=patch_name)
         patch_data["name"] = as_patch_name
         if self._PPD["applied_patches_data"]:
-            top_patch_index = self._PPD["patch_series_data"].index(self._PPD["applied_patches_data"][-1])
+            top_patch_index = self._top_patch_series_position()
             self._PPD["patch_series_data"].insert(top_patch_index + 1, patch_data)
         else:
             self._PPD["patch_series_data"].insert(0, patch_data)
+        self._note_series_change()
+        self.mark_patch_data_as_changed(patch_data)
         return Patch(patch_data, self)
     def get_named_patch(self, patch_name):
-        _index, patch = _find_named_patch_in_list(self._PPD["patch_series_data"], patch_name) # pylint: disable=unused-variable
-        if not patch:
+        position = self.get_series_position(patch_name)
+        if position is None:
             raise DarnItUnknownPatch(patch_name=patch_name)
-        return Patch(patch, self)
+        return Patch(self._PPD["patch_series_data"][position], self)
     def iterate_applied_patches(self, start=0, stop=None, backwards=False):
         if backwards:
             return (Patch(patch_data, self) for patch_data in reversed(self["applied_patches_data"][slice(start, stop)]))
@@ -1547,8 +2150,10 @@ class DataBase(mixins.PedanticDictProxyMixin):
         if not force and self.top_patch.needs_refresh:
             raise DarnItPatchNeedsRefresh(patch_name=self.top_patch_name)
         self.top_patch.undo_apply()
+        for file_path in _PatchData.file_paths(self._PPD["applied_patches_data"][-1]):
+            self.note_file_dropped_from_top_patch(file_path)
         self["applied_patches_data"].pop()
-        self._PPD["combined_patch_data"] = self._PPD["combined_patch_data"]["prev"]
+        self._note_series_change()
         return self.top_patch
     def push_next_patch(self, absorb=False, force=False):
         assert not (absorb and force)
@@ -1563,7 +2168,9 @@ class DataBase(mixins.PedanticDictProxyMixin):
             if not absorb and len(overlaps):
                 raise DarnItPatchOverlapsChanges(overlaps=overlaps)
         self["applied_patches_data"].append(patch.persistent_patch_data)
-        self._PPD["combined_patch_data"] = _CombinedPatchData.make_new_dict(self._PPD["combined_patch_data"])
+        for file_path in patch.get_file_paths_set():
+            self.note_file_added_to_top_patch(file_path)
+        self._note_series_change()
         return patch.do_apply(overlaps)
     def get_kept_patch_names(self):
         return sorted(list(self._PPD["kept_patches"].keys()))
@@ -1571,6 +2178,7 @@ class DataBase(mixins.PedanticDictProxyMixin):
         return sorted(self._PPD["selected_guards"])
     def set_selected_guards(self, guards):
         self._PPD["selected_guards"] = set(guards)
+        self._note_series_change()
     def get_overlap_data(self, file_paths, patch=None):
         """
         Get the data detailing unrefreshed/uncommitted files that will be
@@ -1579,85 +2187,286 @@ class DataBase(mixins.PedanticDictProxyMixin):
         """
         if not file_paths:
             return OverlapData()
-        # NB: let this blow up if index fails
-        patch_index = None if patch is None else self["applied_patches_data"].index(patch.persistent_patch_data)
+        patch_index = None if patch is None else self.get_applied_depth(patch.persistent_patch_data)
+        assert patch is None or patch_index is not None
         remaining_files = set(file_paths)
         uncommitted = set(scm_ifce.get_current_ifce().get_files_with_uncommitted_changes(remaining_files))
         unrefreshed = {}
-        for patch in self.iterate_applied_patches(stop=patch_index, backwards=True):
-            if len(uncommitted) + len(remaining_files) == 0:
-                break
-            patch_file_paths_set = patch.get_file_paths_set(remaining_files)
-            if patch_file_paths_set:
-                remaining_files -= patch_file_paths_set
-                uncommitted -= patch_file_paths_set
-                for patched_file in patch.iterate_files(patch_file_paths_set):
-                    if patched_file.needs_refresh:
-                        unrefreshed[patched_file.path] = patch
+        for file_path in remaining_files:
+            for patch_data in reversed(self.get_applied_patches_data_for_file(file_path)):
+                if patch_index is None or self.get_applied_depth(patch_data) < patch_index:
+                    uncommitted.discard(file_path)
+                    overlapped_patch = Patch(patch_data, self)
+                    if overlapped_patch.get_file(file_path).needs_refresh:
+                        unrefreshed[file_path] = overlapped_patch
+                    break
         return OverlapData(unrefreshed=unrefreshed, uncommitted=uncommitted)
     def get_top_patch_for_file(self, file_path):
-        for applied_patch in reversed(self._PPD["applied_patches_data"]):
-            if file_path in applied_patch["files_data"]:
-                return applied_patch["name"]
-        return None
+        applied_patches_data = self.get_applied_patches_data_for_file(file_path)
+        return applied_patches_data[-1]["name"] if applied_patches_data else None
     def has_patch_with_name(self, name):
-        for patch in self["patch_series_data"]:
-            if patch["name"] == name:
-                return True
-        return False
+        return self.get_series_position(name) is not None
     def incr_ref_count_for_hash(self, git_hash):
-        try:
-            self.blob_ref_counts[git_hash[:2]][git_hash[2:]] += 1
-        except KeyError:
-            try:
-                self.blob_ref_counts[git_hash[:2]][git_hash[2:]] = 1
-            except KeyError:
-                self.blob_ref_counts[git_hash[:2]] = {git_hash[2:] : 1}
-        return self.blob_ref_counts[git_hash[:2]][git_hash[2:]]
-    def check_content(self):
+        self._note_ref_count_for_hash(git_hash)
+        count = self._get_ref_count_for_hash(git_hash) + 1
+        self.blob_ref_counts.set(git_hash, count)
+        return count
+    def check_content(self, full=False, report_progress=None):
+        """Check the stored blobs.  Unless "full" is True, blobs that were
+        verified by an earlier check and whose files haven't changed since
+        (going by their size and modification time) aren't checked again.
+        The blobs are hashed in a pool of processes and "report_progress"
+        (if given) is called with the number of blobs done, the total and
+        the number of bytes verified as each batch of blobs is completed.
+        """
         assert not self.is_writable
         orphans = []
         missing = []
         bad_content = []
+        verified = dict() if full else _read_verified_blobs()
+        new_verified = dict()
+        stamps = dict()
+        batches = []
+        loose_hashes = []
         for base_dir_path, _dir_names, file_names in os.walk(_BLOBS_DIR_PATH): # pylint: disable=unused-variable
             if file_names:
                 key1 = os.path.basename(base_dir_path)
                 for file_name in file_names:
-                    if utils.get_git_hash_for_file(os.path.join(base_dir_path, file_name)) != key1 + file_name:
-                        bad_content.append(key1 + file_name)
-                    try:
-                        if self.blob_ref_counts[key1][file_name] < 1:
-                            orphans.append(key1 + file_name)
-                    except KeyError:
+                    if not _GIT_HASH_CRE.match(key1 + file_name):
+                        # NB: not a blob so report it by its path
+                        orphans.append(os.path.join(base_dir_path, file_name))
+                        continue
+                    fstats = os.stat(os.path.join(base_dir_path, file_name))
+                    stamps[key1 + file_name] = (None, fstats.st_size, fstats.st_mtime_ns)
+                    loose_hashes.append(key1 + file_name)
+                    if self._get_ref_count_for_hash(key1 + file_name) < 1:
                         orphans.append(key1 + file_name)
-        for key1, ref_counts in self.blob_ref_counts.items():
-            for file_name in ref_counts.keys():
-                if not os.path.isfile(os.path.join(_BLOBS_DIR_PATH, key1, file_name)):
-                    missing.append(key1 + file_name)
+        batches.append((None, loose_hashes))
+        # NB: unreferenced blobs in packs are garbage to be dropped at the next repack
+        for blob_pack in self._get_blob_packs():
+            pstats = os.stat(_BlobPack.get_pack_path(blob_pack.name))
+            packed_hashes = []
+            for git_hash in blob_pack.iter_hashes():
+                if self._get_ref_count_for_hash(git_hash) > 0:
+                    stamps[git_hash] = (blob_pack.name, pstats.st_size, pstats.st_mtime_ns)
+                    packed_hashes.append(git_hash)
+            batches.append((blob_pack.name, packed_hashes))
+        jobs = []
+        for pack_name, git_hashes in batches:
+            unverified = []
+            for git_hash in git_hashes:
+                if verified.get(git_hash, None) == stamps[git_hash]:
+                    new_verified[git_hash] = stamps[git_hash]
+                else:
+                    unverified.append(git_hash)
+            git_hashes = unverified
+            for index in range(0, len(git_hashes), _VERIFY_BATCH_SIZE):
+                jobs.append((self.blob_format, pack_name, git_hashes[index:index + _VERIFY_BATCH_SIZE]))
+        total = sum(len(job[2]) for job in jobs)
+        done = 0
+        byte_count = 0
+        executor = concurrent.futures.ProcessPoolExecutor() if total >= _PARALLEL_VERIFY_MIN_BLOBS else None
+        try:
+            if executor is None:
+                results = ((job, _verify_blobs(*job)) for job in jobs)
+            else:
+                futures = {executor.submit(_verify_blobs, *job): job for job in jobs}
+                results = ((futures[future], future.result()) for future in concurrent.futures.as_completed(futures))
+            for job, (bad_hashes, job_byte_count) in results:
+                bad_content += bad_hashes
+                for git_hash in set(job[2]).difference(bad_hashes):
+                    new_verified[git_hash] = stamps[git_hash]
+                done += len(job[2])
+                byte_count += job_byte_count
+                if report_progress:
+                    report_progress(done, total, byte_count)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        if new_verified != verified:
+            _write_verified_blobs(new_verified)
+        for git_hash, _count in self.blob_ref_counts.items():
+            if not os.path.isfile(os.path.join(_BLOBS_DIR_PATH, git_hash[:2], git_hash[2:])) and not self._is_packed(git_hash):
+                missing.append(git_hash)
         return _ContentState(orphans=orphans, missing=missing, bad_content=bad_content)
     def validate_ref_counts(self):
-        blob_ref_counts = self.blob_ref_counts.copy()
-        for patch_data in self["patch_series_data"]:
-            _PatchData.decrement_ref_counts(patch_data, blob_ref_counts)
-        for patch_data in self["kept_patches"].values():
-            _PatchData.decrement_ref_counts(patch_data, blob_ref_counts)
+        expected_counts = collections.Counter()
+        for patch_data in self["patch_series_data"] + list(self["kept_patches"].values()):
+            expected_counts.update(_PatchData.blob_hashes(patch_data))
         bad_ref_counts = []
-        for key1, ref_counts in blob_ref_counts.items():
-            for key2, count in ref_counts.items():
-                if count != 0:
-                    bad_ref_counts.append((key1 + key2, count))
+        for git_hash, count in self.blob_ref_counts.items():
+            discrepancy = count - expected_counts.pop(git_hash, 0)
+            if discrepancy != 0:
+                bad_ref_counts.append((git_hash, discrepancy))
+        for git_hash, expected_count in expected_counts.items():
+            bad_ref_counts.append((git_hash, -expected_count))
         return bad_ref_counts
+    @property
+    def diff_engine(self):
+        """The engine used to generate unified diffs (the configured
+        one unless it has been overridden for this session)
+        """
+        if self._diff_engine is None:
+            self._diff_engine = _get_diff_engine()
+        return self._diff_engine
+    @diff_engine.setter
+    def diff_engine(self, engine):
+        assert engine in diff_engines.ENGINES
+        self._diff_engine = engine
+    def get_restore_mtime(self, operation):
+        """Should files restored by "operation" ("pop" or "push") be
+        given their recorded modify times?
+        """
+        restore_mtime = self.restore_mtime_overrides.get(operation, None)
+        return options.get(operation, "restore_mtime") if restore_mtime is None else restore_mtime
+    def get_diff_lines(self, before, after):
+        """Return the diff lines for the before and after data.  As
+        the sides are identified by their git hashes, the lines are
+        kept in the diff cache and are reused (without reading the
+        content) when the same diff is requested again.
+        """
+        engine = self.diff_engine
+        key = _DiffCache.make_key(before.git_hash, after.git_hash, before.label, after.label, before.timestamp, after.timestamp, engine)
+        diff_lines = self.diff_cache.get(key)
+        if diff_lines is None:
+            diff_lines = _generate_diff_lines(before, after, engine)
+            self.diff_cache.put(key, diff_lines)
+        return diff_lines
+    def generate_diffs(self, sides):
+        """Return the diff data for each of the (before, after) pairs
+        in "sides".  If there are enough of them, they're generated in
+        a pool of worker processes which read the contents themselves.
+        Otherwise, each pair's contents are released once its diff has
+        been generated.  Either way, memory use doesn't grow with the
+        number of files.
+        """
+        engine = self.diff_engine
+        max_workers = options.get("diff", "workers") or os.cpu_count() or 1
+        if len(sides) < _PARALLEL_DIFF_MIN_FILES or max_workers < 2:
+            diffs = []
+            for before, after in sides:
+                diffs.append(_generate_diff(before, after, engine))
+                before.release_content()
+                after.release_content()
+            return diffs
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for index in range(0, len(sides), _PARALLEL_DIFF_BATCH_SIZE):
+                sides_job_data = [(before.get_job_data(), after.get_job_data()) for before, after in sides[index:index + _PARALLEL_DIFF_BATCH_SIZE]]
+                futures.append(executor.submit(_generate_diffs_job, self.blob_format, engine, sides_job_data))
+            return [diff for future in futures for diff in future.result()]
+    def prefetch_diff_lines(self, files_data, with_timestamps=False):
+        """Put the diffs for the files into the diff cache (generating
+        them in parallel) if there are enough of them that aren't
+        already there to make it worthwhile
+        """
+        engine = self.diff_engine
+        keys = []
+        sides = []
+        for file_data in files_data:
+            file_sides = file_data.get_diff_sides_to_generate(with_timestamps=with_timestamps)
+            if file_sides is None:
+                continue
+            before, after = file_sides
+            key = _DiffCache.make_key(before.git_hash, after.git_hash, before.label, after.label, before.timestamp, after.timestamp, engine)
+            if not self.diff_cache.contains(key):
+                keys.append(key)
+                sides.append(file_sides)
+        if len(sides) < _PARALLEL_DIFF_MIN_FILES:
+            return
+        for key, diff in zip(keys, self.generate_diffs(sides)):
+            self.diff_cache.put(key, diff["diff_lines"])
+    def get_git_hash_for_file(self, file_path, lstats=None):
+        """Return the file's git hash (only reading the file if its stat data
+        doesn't match that recorded in the stat cache)
+        """
+        if lstats is None:
+            lstats = os.lstat(file_path)
+        git_hash = self.stat_cache.get_git_hash(file_path, lstats)
+        if git_hash is None:
+            git_hash = _get_git_hash_for_file(file_path)
+            self.stat_cache.set_git_hash(file_path, lstats, git_hash)
+        return git_hash
     def store_content(self, content):
         git_hash = utils.get_git_hash_for_content(content)
-        if self.incr_ref_count_for_hash(git_hash) == 1:
+        if self.incr_ref_count_for_hash(git_hash) == 1 and not self._is_packed(git_hash):
             blob_dir_path = get_blob_dir_path(git_hash)
             if not os.path.exists(blob_dir_path):
                 os.mkdir(blob_dir_path)
             blob_file_path = get_blob_path(git_hash)
             with open(blob_file_path, "wb") as f_obj:
-                f_obj.write(content)
+                f_obj.write(_encode_blob(content, self.blob_format))
             utils.do_turn_off_write_for_file(blob_file_path)
+            self._content_cache.put(git_hash, content)
+        return git_hash
+    def store_file(self, file_path, lstats):
+        """Store the file's content and return its git hash.  The file is
+        hashed in chunks (so that memory use doesn't depend on its size)
+        and only if its content isn't already stored is it cloned (raw)
+        or streamed through the compressor (zlib) into a temporary blob
+        which is then moved into the store.
+        """
+        git_hash = self.stat_cache.get_git_hash(file_path, lstats)
+        if git_hash is not None and self._get_ref_count_for_hash(git_hash) > 0:
+            # NB: the content is already stored so there's no need to read it
+            self.incr_ref_count_for_hash(git_hash)
+            return git_hash
+        # NB: the database is locked for writing so this name is safe
+        tmp_file_path = _BLOB_TMP_FILE_PATH
+        git_hash = _get_git_hash_for_file(file_path)
+        is_unchanged = True
+        if self._get_ref_count_for_hash(git_hash) == 0 and not self._is_packed(git_hash):
+            if self.blob_format == "raw":
+                _copy_file_content(file_path, tmp_file_path)
+            else:
+                # NB: the content is hashed again as it's compressed to be sure that it's what was hashed
+                is_unchanged = _write_compressed_blob_for_file(file_path, tmp_file_path) == git_hash
+        new_lstats = os.lstat(file_path)
+        if not is_unchanged or (new_lstats.st_size, new_lstats.st_mtime_ns) != (lstats.st_size, lstats.st_mtime_ns):
+            # the file changed while it was being read so do it the slow way
+            if os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
+            return self.store_content(_read_file(file_path))
+        self.stat_cache.set_git_hash(file_path, lstats, git_hash)
+        if self.incr_ref_count_for_hash(git_hash) == 1 and not self._is_packed(git_hash):
+            blob_dir_path = get_blob_dir_path(git_hash)
+            if not os.path.exists(blob_dir_path):
+                os.mkdir(blob_dir_path)
+            utils.do_turn_off_write_for_file(tmp_file_path)
+            os.replace(tmp_file_path, get_blob_path(git_hash))
+        elif os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
         return git_hash
+    def write_content_to_file(self, efd, file_path):
+        """Write the content for "efd" to the file (cloning the blob if possible)"""
+        blob_file_path = get_blob_path(efd["git_hash"])
+        if self.blob_format == "raw" and os.path.exists(blob_file_path):
+            _copy_file_content(blob_file_path, file_path)
+        else:
+            with open(file_path, "wb") as f_obj:
+                f_obj.write(self.get_content_for(efd))
+    def restore_content_to_file(self, efd, file_path, restore_mtime=False):
+        """Make the file's content and permissions those for "efd" without
+        rewriting it if its content is already the same (so that its modify
+        time is left alone).  If "restore_mtime" is True a rewritten file is
+        given the modify time recorded with "efd".
+        """
+        try:
+            lstats = os.lstat(file_path)
+        except FileNotFoundError:
+            lstats = None
+        if lstats is None or not stat.S_ISREG(lstats.st_mode) or self.get_git_hash_for_file(file_path, lstats) != efd["git_hash"]:
+            dir_path = os.path.dirname(file_path)
+            if dir_path and not os.path.exists(dir_path):
+                os.makedirs(dir_path)
+            self.write_content_to_file(efd, file_path)
+            if restore_mtime:
+                os.utime(file_path, ns=(efd["lstats"].st_atime_ns, efd["lstats"].st_mtime_ns))
+            lstats = None
+        permissions = _EssentialFileData.permissions(efd)
+        if lstats is None or stat.S_IMODE(lstats.st_mode) != permissions:
+            os.chmod(file_path, permissions)
+            self.stat_cache.set_git_hash(file_path, os.lstat(file_path), efd["git_hash"])
     def store_file_content(self, file_path, overlaps=OverlapData()):
         overlapped_patch = overlaps.unrefreshed.get(file_path, None)
         if overlapped_patch:
@@ -1668,8 +2477,8 @@ class DataBase(mixins.PedanticDictProxyMixin):
                 # Will occur if file has been added to SCM but not committed
                 return None
         elif os.path.exists(file_path):
-            with open(file_path, "rb") as f_obj:
-                contents = f_obj.read()
+            lstats = os.lstat(file_path)
+            return _EssentialFileData.new_dict(git_hash=self.store_file(file_path, lstats), lstats=lstats)
         else:
             return None
         return _EssentialFileData.new_dict(git_hash=self.store_content(contents), lstats=os.lstat(file_path))
@@ -1686,27 +2495,148 @@ class DataBase(mixins.PedanticDictProxyMixin):
         return cloned_data
     def release_stored_content(self, efd):
         if efd is not None:
+            self._note_ref_count_for_hash(efd["git_hash"])
             dir_name, file_name = efd["git_hash"][:2], efd["git_hash"][2:]
-            self.blob_ref_counts[dir_name][file_name] -= 1
-            if self.blob_ref_counts[dir_name][file_name] == 0:
-                os.remove(os.path.join(_BLOBS_DIR_PATH, dir_name, file_name))
-                del self.blob_ref_counts[dir_name][file_name]
-    @staticmethod
-    def get_content_for(obj):
+            count = self._get_ref_count_for_hash(efd["git_hash"]) - 1
+            self.blob_ref_counts.set(efd["git_hash"], count)
+            if count == 0:
+                # NB: packed blobs stay in their pack until the next repack
+                blob_file_path = os.path.join(_BLOBS_DIR_PATH, dir_name, file_name)
+                if os.path.exists(blob_file_path):
+                    os.remove(blob_file_path)
+                self._content_cache.discard(efd["git_hash"])
+                extracted_file_path = os.path.join(_EXTRACTED_BLOBS_DIR_PATH, efd["git_hash"])
+                if os.path.exists(extracted_file_path):
+                    os.remove(extracted_file_path)
+    def _get_blob_packs(self):
+        if self._blob_packs is None:
+            self._blob_packs = [_BlobPack(pack_name) for pack_name in _BlobPack.get_pack_names()]
+        return self._blob_packs
+    def _is_packed(self, git_hash):
+        return any(git_hash in blob_pack for blob_pack in self._get_blob_packs())
+    def close_blob_packs(self):
+        if self._blob_packs is not None:
+            for blob_pack in self._blob_packs:
+                blob_pack.close()
+            self._blob_packs = None
+    def _read_blob(self, git_hash):
+        return _read_stored_blob(git_hash, self.blob_format, self._get_blob_packs)
+    def _get_blob_groups(self):
+        """Return lists of the referenced blobs grouped by the path of the
+        file whose versions they are (as those are likely to be similar)
+        """
+        groups = collections.OrderedDict()
+        for patch_data in self._PPD["patch_series_data"] + list(self._PPD["kept_patches"].values()):
+            for file_path, file_data in sorted(patch_data["files_data"].items()):
+                group = groups.setdefault(file_path, [])
+                for efd in (file_data["orig"], file_data["darned"]):
+                    if efd is not None:
+                        group.append(efd["git_hash"])
+                if file_data["came_from"] is not None:
+                    groups.setdefault(file_data["came_from"]["file_path"], []).append(file_data["came_from"]["orig"]["git_hash"])
+        seen = set()
+        for group in groups.values():
+            # NB: a version is often in a group more than once (e.g. one
+            # patch's "darned" is the next patch's "orig") so check as we go
+            hashes = []
+            for git_hash in group:
+                if git_hash not in seen and self._get_ref_count_for_hash(git_hash) > 0:
+                    seen.add(git_hash)
+                    hashes.append(git_hash)
+            if hashes:
+                yield hashes
+        # NB: just in case the ref counts and the patches disagree
+        others = [git_hash for git_hash, _count in self.blob_ref_counts.items() if git_hash not in seen]
+        if others:
+            yield others
+    def _iter_pack_entries(self, depths):
+        """Generate the (git_hash, base_hash, data) entries for a pack with
+        each blob delta encoded against the best of the few larger versions
+        of the same file that precede it (if that saves at least half)
+        """
+        window = 3
+        for group in self._get_blob_groups():
+            contents = sorted(((self._read_blob(git_hash), git_hash) for git_hash in group), key=lambda x: (-len(x[0]), x[1]))
+            for index, (content, git_hash) in enumerate(contents):
+                best = None
+                for base_content, base_hash in contents[max(0, index - window):index]:
+                    if depths[base_hash] >= _BlobPack.MAX_DELTA_DEPTH:
+                        continue
+                    delta = _make_delta(base_content, content, len(content) // 2 if best is None else len(best[1]))
+                    if delta is not None:
+                        best = (base_hash, delta)
+                if best is None:
+                    depths[git_hash] = 0
+                    yield (git_hash, None, content)
+                else:
+                    depths[git_hash] = depths[best[0]] + 1
+                    yield (git_hash, best[0], best[1])
+    def repack_blobs(self, blob_format):
+        """Move all referenced blobs into a single pack (delta encoding
+        similar blobs) and discard the rest.  Nothing is discarded unless
+        every referenced blob can be read back from the new pack.
+        """
+        old_pack_names = [blob_pack.name for blob_pack in self._get_blob_packs()]
+        referenced = [git_hash for git_hash, _count in self.blob_ref_counts.items()]
+        depths = dict()
+        pack_name = _BlobPack.write(self._iter_pack_entries(depths), blob_format) if referenced else None
+        if pack_name is not None:
+            bad_hashes, _byte_count = _verify_blobs(blob_format, pack_name, referenced)
+            if bad_hashes:
+                # NB: a pack with the same name has the same content so it's no worse
+                if pack_name not in old_pack_names:
+                    _BlobPack.remove(pack_name)
+                raise DarnItBadBlobPack(bad_hashes=bad_hashes)
+        self.close_blob_packs()
+        for old_pack_name in old_pack_names:
+            if old_pack_name != pack_name:
+                _BlobPack.remove(old_pack_name)
+        for blob_dir_name in os.listdir(_BLOBS_DIR_PATH):
+            shutil.rmtree(os.path.join(_BLOBS_DIR_PATH, blob_dir_name))
+        if os.path.isdir(_EXTRACTED_BLOBS_DIR_PATH):
+            shutil.rmtree(_EXTRACTED_BLOBS_DIR_PATH)
+        # NB: there are no loose blobs left to be converted
+        _write_file_atomically(_BLOB_FORMAT_FILE_PATH, blob_format.encode())
+        self.blob_format = blob_format
+        return (len(referenced), len([depth for depth in depths.values() if depth > 0]))
+    def get_content_for(self, obj):
         if obj is None:
             return b""
-        else:
-            with open(get_blob_path(obj["git_hash"]), "rb") as f_obj:
-                return f_obj.read()
+        content = self._content_cache.get(obj["git_hash"])
+        if content is None:
+            content = self._read_blob(obj["git_hash"])
+            self._content_cache.put(obj["git_hash"], content)
+        return content
+    @property
+    def content_cache_stats(self):
+        """Hit/miss counts and occupancy of the blob content cache"""
+        return self._content_cache.stats
+    def get_blob_file_path(self, git_hash):
+        """Get the path of a file containing the (uncompressed) content
+        associated with "git_hash" for use by external tools.
+        """
+        if self.blob_format == "raw" and os.path.exists(get_blob_path(git_hash)):
+            return get_blob_path(git_hash)
+        extracted_file_path = os.path.join(_EXTRACTED_BLOBS_DIR_PATH, git_hash)
+        if not os.path.exists(extracted_file_path):
+            if not os.path.isdir(_EXTRACTED_BLOBS_DIR_PATH):
+                os.makedirs(_EXTRACTED_BLOBS_DIR_PATH, exist_ok=True)
+            # NB: readers may do this concurrently so each needs its own temporary file
+            fd, tmp_file_path = tempfile.mkstemp(dir=_EXTRACTED_BLOBS_DIR_PATH)
+            with os.fdopen(fd, "wb") as f_obj:
+                f_obj.write(self._read_blob(git_hash))
+            utils.do_turn_off_write_for_file(tmp_file_path)
+            os.replace(tmp_file_path, extracted_file_path)
+        return extracted_file_path
 
 def do_create_db(dir_path=None, description=None):
     """Create a patch database in the current directory?"""
     def rollback():
         """Undo steps that were completed before failure occured"""
-        for filnm in [patches_data_file_path, database_lock_file_path, blob_ref_count_file_path, description_file_path]:
+        for filnm in [patches_data_file_path, database_lock_file_path, blob_ref_count_file_path, description_file_path, blob_format_file_path]:
             if os.path.exists(filnm):
                 os.remove(filnm)
-        for dirnm in [database_blobs_dir_path, database_dir_path]:
+        for dirnm in [database_blobs_dir_path, database_shards_dir_path, database_dir_path]:
             if os.path.exists(dirnm):
                 os.rmdir(dirnm)
     if not dir_path:
@@ -1717,9 +2647,11 @@ def do_create_db(dir_path=None, description=None):
         return CmdResult.ERROR
     database_dir_path = os.path.join(dir_path, _DIR_PATH)
     database_blobs_dir_path = os.path.join(dir_path, _BLOBS_DIR_PATH)
+    database_shards_dir_path = os.path.join(dir_path, _PATCH_SHARDS_DIR_PATH)
     patches_data_file_path = os.path.join(dir_path, _PATCHES_DATA_FILE_PATH)
     blob_ref_count_file_path = os.path.join(dir_path, _BLOB_REF_COUNT_FILE_PATH)
     description_file_path = os.path.join(dir_path, _DESCRIPTION_FILE_PATH)
+    blob_format_file_path = os.path.join(dir_path, _BLOB_FORMAT_FILE_PATH)
     if os.path.exists(database_dir_path):
         if os.path.exists(database_blobs_dir_path) and os.path.exists(patches_data_file_path):
             RCTX.stderr.write(_("Database already exists.\n"))
@@ -1731,15 +2663,18 @@ def do_create_db(dir_path=None, description=None):
         dir_mode = stat.S_IRWXU|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH
         os.mkdir(database_dir_path, dir_mode)
         os.mkdir(database_blobs_dir_path, dir_mode)
+        os.mkdir(database_shards_dir_path, dir_mode)
         with open(database_lock_file_path, "wb") as f_obj:
             f_obj.write(b"0")
         with open(description_file_path, "w") as f_obj:
             f_obj.write(_tidy_text(description))
-        db_obj = _DataBaseData.new_dict()
         with open(patches_data_file_path, "wb", stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH) as f_obj:
-            pickle.dump(db_obj, f_obj)
+            pickle.dump(_DataBaseStore.new_snapshot(), f_obj)
         with open(blob_ref_count_file_path, "wb", stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH) as f_obj:
-            pickle.dump(dict(), f_obj)
+            f_obj.write(_BlobRefCounts.make_table([]))
+        if options.get("blobs", "compress"):
+            with open(blob_format_file_path, "w") as f_obj:
+                f_obj.write("zlib")
     except OSError as edata:
         rollback()
         RCTX.stderr.write(edata.strerror)
@@ -1768,28 +2703,906 @@ else:
     def unlock_db(fd):
         return fcntl.lockf(fd, fcntl.LOCK_UN)
 
+# from <linux/fs.h>
+_FICLONE = 0x40049409
+
+def _clone_file(src_fd, dst_fd):
+    """Make the destination a copy-on-write clone (reflink) of the source
+    where the file system supports it (e.g. btrfs and XFS)
+    """
+    if os.name != "posix":
+        raise OSError(_("Cloning files is not supported."))
+    fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+
+def _copy_file_range(src_fd, dst_fd, size):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(_("copy_file_range() is not supported."))
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(src_fd, dst_fd, size - copied)
+        if count == 0:
+            break
+        copied += count
+
+def _sendfile(src_fd, dst_fd, size):
+    if not hasattr(os, "sendfile"):
+        raise OSError(_("sendfile() is not supported."))
+    copied = 0
+    while copied < size:
+        count = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if count == 0:
+            break
+        copied += count
+
+def _copy_file_content(src_path, dst_path):
+    """Copy the content of one file to another as cheaply as possible: by
+    cloning it, by copying it within the kernel or, failing those, by
+    copying it through memory.
+    """
+    with open(src_path, "rb", buffering=0) as src_f_obj, open(dst_path, "wb", buffering=0) as dst_f_obj:
+        src_fd, dst_fd = src_f_obj.fileno(), dst_f_obj.fileno()
+        size = os.fstat(src_fd).st_size
+        for copy_method in (_clone_file, functools.partial(_copy_file_range, size=size), functools.partial(_sendfile, size=size)):
+            try:
+                copy_method(src_fd, dst_fd)
+                return
+            except OSError:
+                # NB: start again from scratch with the next method
+                src_f_obj.seek(0)
+                dst_f_obj.seek(0)
+                dst_f_obj.truncate()
+        shutil.copyfileobj(src_f_obj, dst_f_obj)
+
+def _copy_file(src_path, dst_path):
+    """Copy the file's content and metadata (like shutil.copy2())"""
+    _copy_file_content(src_path, dst_path)
+    shutil.copystat(src_path, dst_path)
+
+def _write_file_atomically(file_path, content):
+    """Replace the file's content in a way that survives interruption"""
+    tmp_file_path = file_path + os.extsep + "tmp"
+    with open(tmp_file_path, "wb") as f_obj:
+        f_obj.write(content)
+    os.replace(tmp_file_path, file_path)
+
+def _write_file_unlocked(file_path, content):
+    """Replace the file's content without holding the database's write
+    lock (failure is harmless as such files are only caches)
+    """
+    # NB: readers may do this concurrently so each needs its own temporary file
+    try:
+        fd, tmp_file_path = tempfile.mkstemp(dir=_DIR_PATH)
+    except OSError:
+        return False
+    try:
+        with os.fdopen(fd, "wb") as f_obj:
+            f_obj.write(content)
+        os.replace(tmp_file_path, file_path)
+    except OSError:
+        os.remove(tmp_file_path)
+        return False
+    return True
+
+# Blobs are verified in batches and only in parallel if there are enough of them
+_VERIFY_BATCH_SIZE = 64
+_PARALLEL_VERIFY_MIN_BLOBS = 256
+
+def _verify_blobs(blob_format, pack_name, git_hashes):
+    """Return those of the blobs whose content doesn't match its hash and
+    the number of bytes checked.  The blobs are read from the named pack
+    (or their loose files if it's None).  This runs in worker processes.
+    """
+    bad_hashes = []
+    byte_count = 0
+    blob_pack = None if pack_name is None else _BlobPack(pack_name)
+    try:
+        for git_hash in git_hashes:
+            try:
+                if blob_pack is None:
+                    with open(get_blob_path(git_hash), "rb") as f_obj:
+                        content = _decode_blob(f_obj.read(), blob_format, git_hash)
+                else:
+                    content = blob_pack.get_content(git_hash)
+            except Exception: # pylint: disable=broad-except
+                # NB: a corrupt blob or pack can fail in any number of ways
+                content = None
+            if content is None or utils.get_git_hash_for_content(content) != git_hash:
+                bad_hashes.append(git_hash)
+            else:
+                byte_count += len(content)
+    finally:
+        if blob_pack is not None:
+            blob_pack.close()
+    return (bad_hashes, byte_count)
+
+def _read_verified_blobs():
+    """Return the stamps (location, size and modification time) of the
+    blobs as they were when they were last verified
+    """
+    try:
+        with open(_VERIFIED_BLOBS_FILE_PATH, "rb") as f_obj:
+            return pickle.load(f_obj)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return dict()
+
+def _write_verified_blobs(verified):
+    _write_file_unlocked(_VERIFIED_BLOBS_FILE_PATH, pickle.dumps(verified, pickle.HIGHEST_PROTOCOL))
+
+class _DiffCache(object):
+    """A persistent cache of generated diff lines.  Each entry is a
+    file whose name is made from the git hashes of the diff's two sides
+    and the parameters used to generate it.  Entries' modification
+    times are updated when they're used so that the least recently used
+    can be evicted when the cache's total size exceeds its maximum.
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        # NB: entries added by this session are also kept in memory
+        self._added = dict()
+    @staticmethod
+    def make_key(*args):
+        return hashlib.sha1(repr(args).encode()).hexdigest()
+    def contains(self, key):
+        return key in self._added or os.path.exists(os.path.join(_DIFF_CACHE_DIR_PATH, key))
+    def get(self, key):
+        if key in self._added:
+            return self._added[key]
+        file_path = os.path.join(_DIFF_CACHE_DIR_PATH, key)
+        try:
+            with open(file_path, "rb") as f_obj:
+                diff_lines = pickle.loads(zlib.decompress(f_obj.read()))
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return None
+        try:
+            os.utime(file_path)
+        except OSError:
+            pass
+        return diff_lines
+    def put(self, key, diff_lines):
+        self._added[key] = diff_lines
+        # NB: failure is harmless as this is only a cache
+        try:
+            os.makedirs(_DIFF_CACHE_DIR_PATH, exist_ok=True)
+        except OSError:
+            return
+        _write_file_unlocked(os.path.join(_DIFF_CACHE_DIR_PATH, key), zlib.compress(pickle.dumps(diff_lines, pickle.HIGHEST_PROTOCOL)))
+    def trim(self):
+        """Evict the least recently used entries until the cache fits
+        (failure is harmless as this is only a cache)
+        """
+        if not self._added:
+            return
+        self._added = dict()
+        entries = []
+        total_size = 0
+        try:
+            file_names = os.listdir(_DIFF_CACHE_DIR_PATH)
+        except OSError:
+            return
+        for file_name in file_names:
+            file_path = os.path.join(_DIFF_CACHE_DIR_PATH, file_name)
+            try:
+                fstats = os.stat(file_path)
+            except OSError:
+                continue
+            entries.append((fstats.st_mtime_ns, fstats.st_size, file_path))
+            total_size += fstats.st_size
+        for _mtime, size, file_path in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                return
+            total_size -= size
+
+class _StatCache(object):
+    """A persistent map from file paths to their git hashes (keyed by
+    the files' stat data) so that files that haven't changed don't have
+    to be read and hashed again.  As with git's index, entries for files
+    modified no earlier than the cache was written are "racy" (they may
+    have changed without their stat data changing) and are discarded.
+    """
+    def __init__(self):
+        self._entries = dict()
+        self._is_dirty = False
+        try:
+            with open(_STAT_CACHE_FILE_PATH, "rb") as f_obj:
+                timestamp = os.fstat(f_obj.fileno()).st_mtime_ns
+                entries = pickle.load(f_obj)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        for file_path, entry in entries.items():
+            if entry[3] < timestamp and entry[4] < timestamp:
+                self._entries[file_path] = entry
+            else:
+                self._is_dirty = True
+    @staticmethod
+    def _stat_key(lstats):
+        return (lstats.st_dev, lstats.st_ino, lstats.st_size, lstats.st_mtime_ns, lstats.st_ctime_ns)
+    def get_git_hash(self, file_path, lstats):
+        entry = self._entries.get(file_path, None)
+        if entry is None or entry[:5] != self._stat_key(lstats):
+            return None
+        return entry[5]
+    def set_git_hash(self, file_path, lstats, git_hash):
+        # NB: symbolic links are hashed via their targets which lstat() doesn't see
+        if stat.S_ISREG(lstats.st_mode):
+            self._entries[file_path] = self._stat_key(lstats) + (git_hash,)
+            self._is_dirty = True
+    def save(self):
+        """Write the cache to disk if it has changed (failure is harmless)"""
+        if self._is_dirty and _write_file_unlocked(_STAT_CACHE_FILE_PATH, pickle.dumps(self._entries, pickle.HIGHEST_PROTOCOL)):
+            self._is_dirty = False
+
+class _LazyPatchData(dict):
+    """Patch data whose "files_data" is only read from its shard when
+    it is first accessed.  The patch's file paths are available from
+    the index without loading the shard.
+    """
+    def __init__(self, index_entry, load_files_data):
+        dict.__init__(self, name=index_entry["name"], description=index_entry["description"], pos_guards=index_entry["pos_guards"], neg_guards=index_entry["neg_guards"])
+        self.shard_id = index_entry["shard"]
+        self._file_paths = index_entry["file_paths"]
+        self._load_files_data = load_files_data
+    def __missing__(self, key):
+        if key != "files_data" or self._load_files_data is None:
+            raise KeyError(key)
+        self["files_data"] = self._load_files_data(self.shard_id)
+        self._load_files_data = None
+        return self["files_data"]
+    @property
+    def is_loaded(self):
+        return "files_data" in self
+    @property
+    def file_paths(self):
+        return self["files_data"].keys() if self.is_loaded else self._file_paths
+
+class _BlobRefCounts(object):
+    """The blobs' reference counts keyed by git hash.  These are kept
+    on disk as a table of (binary hash, count) entries sorted by hash
+    which is only read when a count is first needed and is binary
+    searched in place.  Changes are held in a dictionary overlaying
+    the table (with a count of zero meaning that the entry is gone)
+    until the table is rewritten.
+    """
+    _MAGIC = b"DRC1"
+    _HEADER = struct.Struct(">4sI") # magic and entry count
+    _ENTRY = struct.Struct(">20sI") # binary git hash and count
+    def __init__(self, load_table):
+        self._load_table = load_table
+        self._table = None
+        self._size = 0
+        self._changes = dict()
+    @classmethod
+    def make_table(cls, items):
+        """Return the table for "items" ((git hash, count) pairs sorted by hash)"""
+        entries = [cls._ENTRY.pack(bytes.fromhex(git_hash), count) for git_hash, count in items if count]
+        return cls._HEADER.pack(cls._MAGIC, len(entries)) + b"".join(entries)
+    @classmethod
+    def read_table(cls, file_path):
+        with open(file_path, "rb") as f_obj:
+            table = f_obj.read()
+        if table[:len(cls._MAGIC)] != cls._MAGIC:
+            # NB: older databases have a pickled dict of dicts
+            ref_counts = pickle.loads(table)
+            table = cls.make_table(sorted((key1 + key2, count) for key1, counts in ref_counts.items() for key2, count in counts.items()))
+        return table
+    def load(self):
+        """Make sure that the table has been read"""
+        if self._table is None:
+            self._table = self._load_table()
+            self._load_table = None
+            magic, self._size = self._HEADER.unpack_from(self._table)
+            assert magic == self._MAGIC
+    def _lookup(self, git_hash):
+        self.load()
+        key = bytes.fromhex(git_hash)
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self._HEADER.size + mid * self._ENTRY.size
+            mid_key = self._table[offset:offset + 20]
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return self._ENTRY.unpack_from(self._table, offset)[1]
+        return 0
+    def get(self, git_hash):
+        try:
+            return self._changes[git_hash]
+        except KeyError:
+            return self._lookup(git_hash)
+    def set(self, git_hash, count):
+        self._changes[git_hash] = count
+    def items(self):
+        """Return (git hash, count) pairs for the referenced blobs sorted by hash"""
+        self.load()
+        counts = {key.hex() : count for key, count in self._ENTRY.iter_unpack(self._table[self._HEADER.size:])}
+        counts.update(self._changes)
+        return sorted((git_hash, count) for git_hash, count in counts.items() if count)
+
+class _DataBaseStore:
+    """Persistent storage for the patch database.  The state is kept
+    as an index snapshot (holding each patch's name, description,
+    guards and file paths along with the series and applied patch
+    names) plus a journal of change records, one appended per mutable
+    session, that is replayed on load.  Each patch's files' data is
+    kept in a separate content addressed shard which is only read when
+    the patch's files are accessed.  A change record only contains the
+    index entries and reference counts that the session marked as
+    changed (with their complete new values so that replaying a record
+    is idempotent) and the journal is compacted into the snapshot when
+    it grows larger than the snapshot.  Each compaction starts a new
+    generation (with its own reference counts table) and records are
+    tagged with the generation they were written in so that those that
+    the snapshot already holds are skipped on replay.
+    """
+    BACKEND = "pickle"
+    VERSION = 2
+    _FRAME_HDR = struct.Struct(">II") # record length and CRC32
+    def __init__(self):
+        self._selected_guards = set()
+        self._series_names = []
+        self._applied_names = []
+        self._patch_index = dict()
+        self._kept_patch_index = dict()
+        self._pending_shards = dict()
+        self._snapshot_size = 0
+        self._journal_size = 0
+        self._needs_compaction = False
+        self._generation = 0
+    @staticmethod
+    def _ref_counts_file_path(generation):
+        # NB: generation 0 is the table written by "darn init"
+        if generation == 0:
+            return _BLOB_REF_COUNT_FILE_PATH
+        return _BLOB_REF_COUNT_FILE_PATH + os.extsep + str(generation)
+    @classmethod
+    def new_snapshot(cls):
+        return {"version" : cls.VERSION, "selected_guards" : set(), "series" : [], "applied" : [], "patches" : dict(), "kept_patches" : dict()}
+    def _make_index_entry(self, patch_data):
+        if isinstance(patch_data, _LazyPatchData) and not patch_data.is_loaded:
+            shard_id = patch_data.shard_id
+        else:
+            shard = pickle.dumps(patch_data["files_data"])
+            shard_id = hashlib.sha1(shard).hexdigest()
+            self._pending_shards[shard_id] = shard
+        return {
+            "name" : patch_data["name"],
+            "description" : patch_data["description"],
+            "pos_guards" : set(patch_data["pos_guards"]),
+            "neg_guards" : set(patch_data["neg_guards"]),
+            "file_paths" : sorted(_PatchData.file_paths(patch_data)),
+            "shard" : shard_id,
+        }
+    def _load_snapshot(self):
+        with open(_PATCHES_DATA_FILE_PATH, "rb") as f_obj:
+            snapshot = pickle.load(f_obj)
+            self._snapshot_size = f_obj.tell()
+        self._generation = snapshot.get("generation", 0)
+        if snapshot.get("version", 0) < self.VERSION:
+            # Older layouts held whole patches.  Convert them and write
+            # the new layout at the next opportunity.
+            if "version" not in snapshot:
+                series = snapshot["patch_series_data"]
+                applied_names = [patch_data["name"] for patch_data in snapshot["applied_patches_data"]]
+                kept_patches = snapshot["kept_patches"]
+            else:
+                series = [pickle.loads(snapshot["patches"][name]) for name in snapshot["series"]]
+                applied_names = snapshot["applied"]
+                kept_patches = {name : pickle.loads(pickled) for name, pickled in snapshot["kept_patches"].items()}
+            self._selected_guards = snapshot["selected_guards"]
+            self._series_names = [patch_data["name"] for patch_data in series]
+            self._applied_names = applied_names
+            self._patch_index = {patch_data["name"] : self._make_index_entry(patch_data) for patch_data in series}
+            self._kept_patch_index = {name : self._make_index_entry(patch_data) for name, patch_data in kept_patches.items()}
+            self._needs_compaction = True
+        else:
+            self._selected_guards = snapshot["selected_guards"]
+            self._series_names = snapshot["series"]
+            self._applied_names = snapshot["applied"]
+            self._patch_index = snapshot["patches"]
+            self._kept_patch_index = snapshot["kept_patches"]
+    def _apply_record(self, record):
+        self._selected_guards = record.get("selected_guards", self._selected_guards)
+        self._applied_names = record.get("applied", self._applied_names)
+        self._patch_index.update(record.get("patches", dict()))
+        if "series" in record:
+            self._series_names = record["series"]
+            self._patch_index = {name : self._patch_index[name] for name in self._series_names}
+        for name, index_entry in record.get("kept_patches", dict()).items():
+            if index_entry is None:
+                self._kept_patch_index.pop(name, None)
+            else:
+                self._kept_patch_index[name] = index_entry
+    @staticmethod
+    def _apply_ref_counts(ref_counts, blob_ref_counts):
+        for git_hash, count in ref_counts.items():
+            blob_ref_counts.set(git_hash, count)
+    def _replay_journal(self, blob_ref_counts):
+        try:
+            with open(_JOURNAL_FILE_PATH, "rb") as f_obj:
+                journal = f_obj.read()
+        except FileNotFoundError:
+            journal = b""
+        offset = 0
+        while offset + self._FRAME_HDR.size <= len(journal):
+            length, crc = self._FRAME_HDR.unpack_from(journal, offset)
+            start = offset + self._FRAME_HDR.size
+            record_bytes = journal[start:start + length]
+            if len(record_bytes) != length or zlib.crc32(record_bytes) != crc:
+                # torn write from an interrupted session: ignore the rest
+                self._needs_compaction = True
+                break
+            record = pickle.loads(record_bytes)
+            if record.get("generation", 0) == self._generation:
+                self._apply_record(record)
+                self._apply_ref_counts(record.get("blob_ref_counts", dict()), blob_ref_counts)
+            else:
+                # left over from an interrupted compaction
+                self._needs_compaction = True
+            offset = start + length
+        self._journal_size = offset
+    def _load_files_data(self, shard_id):
+        try:
+            return pickle.loads(self._pending_shards[shard_id])
+        except KeyError:
+            with open(os.path.join(_PATCH_SHARDS_DIR_PATH, shard_id), "rb") as f_obj:
+                return pickle.load(f_obj)
+    def _write_pending_shards(self):
+        if not self._pending_shards:
+            return
+        if not os.path.isdir(_PATCH_SHARDS_DIR_PATH):
+            os.mkdir(_PATCH_SHARDS_DIR_PATH)
+        for shard_id, shard in self._pending_shards.items():
+            shard_file_path = os.path.join(_PATCH_SHARDS_DIR_PATH, shard_id)
+            if not os.path.exists(shard_file_path):
+                _write_file_atomically(shard_file_path, shard)
+        self._pending_shards = dict()
+    def load(self):
+        """Return the patches' persistent data and the blob reference counts"""
+        self._load_snapshot()
+        # NB: the counts table is only read if it's needed
+        ref_counts_file_path = self._ref_counts_file_path(self._generation)
+        blob_ref_counts = _BlobRefCounts(lambda: _BlobRefCounts.read_table(ref_counts_file_path))
+        self._replay_journal(blob_ref_counts)
+        patches = {name : _LazyPatchData(self._patch_index[name], self._load_files_data) for name in self._series_names}
+        patches_data = _DataBaseData.new_dict(
+            selected_guards=set(self._selected_guards),
+            patch_series_data=[patches[name] for name in self._series_names],
+            applied_patches_data=[patches[name] for name in self._applied_names],
+            kept_patches={name : _LazyPatchData(index_entry, self._load_files_data) for name, index_entry in self._kept_patch_index.items()},
+        )
+        return (patches_data, blob_ref_counts)
+    def _make_record(self, patches_data, blob_ref_counts, changed_patches_data, changed_blob_hashes):
+        record = dict()
+        if patches_data["selected_guards"] != self._selected_guards:
+            record["selected_guards"] = set(patches_data["selected_guards"])
+        series_names = [patch_data["name"] for patch_data in patches_data["patch_series_data"]]
+        if series_names != self._series_names:
+            record["series"] = series_names
+        applied_names = [patch_data["name"] for patch_data in patches_data["applied_patches_data"]]
+        if applied_names != self._applied_names:
+            record["applied"] = applied_names
+        changed_ids = {id(patch_data) for patch_data in changed_patches_data}
+        patches = dict()
+        for patch_data in patches_data["patch_series_data"]:
+            if id(patch_data) in changed_ids or patch_data["name"] not in self._patch_index:
+                patches[patch_data["name"]] = self._make_index_entry(patch_data)
+        if patches:
+            record["patches"] = patches
+        kept_patches = {name : None for name in self._kept_patch_index if name not in patches_data["kept_patches"]}
+        for name, patch_data in patches_data["kept_patches"].items():
+            if id(patch_data) in changed_ids or name not in self._kept_patch_index:
+                kept_patches[name] = self._make_index_entry(patch_data)
+        if kept_patches:
+            record["kept_patches"] = kept_patches
+        if changed_blob_hashes:
+            record["blob_ref_counts"] = {git_hash : blob_ref_counts.get(git_hash) for git_hash in changed_blob_hashes}
+        return record
+    def commit(self, patches_data, blob_ref_counts, changed_patches_data, changed_blob_hashes):
+        """Record the changes made to the data since it was loaded"""
+        record = self._make_record(patches_data, blob_ref_counts, changed_patches_data, changed_blob_hashes)
+        if not record:
+            return
+        self._apply_record(record)
+        record_bytes = pickle.dumps(dict(record, generation=self._generation))
+        if self._needs_compaction or self._journal_size + len(record_bytes) > self._snapshot_size:
+            self.compact(blob_ref_counts)
+        else:
+            # NB: shards must be in place before any record refers to them
+            self._write_pending_shards()
+            with open(_JOURNAL_FILE_PATH, "ab") as f_obj:
+                f_obj.write(self._FRAME_HDR.pack(len(record_bytes), zlib.crc32(record_bytes)))
+                f_obj.write(record_bytes)
+            self._journal_size += self._FRAME_HDR.size + len(record_bytes)
+    def compact(self, blob_ref_counts):
+        """Fold the journal into a new snapshot and discard unused shards"""
+        generation = self._generation + 1
+        snapshot = self.new_snapshot()
+        snapshot["generation"] = generation
+        snapshot["selected_guards"] = self._selected_guards
+        snapshot["series"] = self._series_names
+        snapshot["applied"] = self._applied_names
+        snapshot["patches"] = self._patch_index
+        snapshot["kept_patches"] = self._kept_patch_index
+        snapshot_bytes = pickle.dumps(snapshot)
+        self._write_pending_shards()
+        # NB: replacing the snapshot is the commit point.  The new counts
+        # table is written first under its generation's name so that the
+        # old snapshot, counts table and journal remain consistent if we're
+        # interrupted before then and the journal's records are ignored by
+        # the new snapshot if we're interrupted after then.  The old counts
+        # table and unused shards are removed last.
+        ref_counts_file_path = self._ref_counts_file_path(generation)
+        _write_file_atomically(ref_counts_file_path, _BlobRefCounts.make_table(blob_ref_counts.items()))
+        _write_file_atomically(_PATCHES_DATA_FILE_PATH, snapshot_bytes)
+        self._generation = generation
+        with open(_JOURNAL_FILE_PATH, "wb"):
+            pass
+        ref_counts_file_name = os.path.basename(_BLOB_REF_COUNT_FILE_PATH)
+        for file_name in os.listdir(_DIR_PATH):
+            file_path = os.path.join(_DIR_PATH, file_name)
+            if file_name.startswith(ref_counts_file_name) and file_path != ref_counts_file_path:
+                os.remove(file_path)
+        self._snapshot_size = len(snapshot_bytes)
+        self._journal_size = 0
+        self._needs_compaction = False
+        in_use = {index_entry["shard"] for index_entry in self._patch_index.values()}
+        in_use.update(index_entry["shard"] for index_entry in self._kept_patch_index.values())
+        for shard_id in os.listdir(_PATCH_SHARDS_DIR_PATH) if os.path.isdir(_PATCH_SHARDS_DIR_PATH) else []:
+            if shard_id not in in_use:
+                os.remove(os.path.join(_PATCH_SHARDS_DIR_PATH, shard_id))
+    def close(self):
+        pass
+    @classmethod
+    def create(cls, patches_data, blob_ref_counts):
+        """Create a store holding the given data"""
+        store = cls()
+        store._selected_guards = set(patches_data["selected_guards"])
+        store._series_names = [patch_data["name"] for patch_data in patches_data["patch_series_data"]]
+        store._applied_names = [patch_data["name"] for patch_data in patches_data["applied_patches_data"]]
+        store._patch_index = {patch_data["name"] : store._make_index_entry(patch_data) for patch_data in patches_data["patch_series_data"]}
+        store._kept_patch_index = {name : store._make_index_entry(patch_data) for name, patch_data in patches_data["kept_patches"].items()}
+        store.compact(blob_ref_counts)
+    @staticmethod
+    def remove():
+        """Remove the store's files"""
+        ref_counts_file_name = os.path.basename(_BLOB_REF_COUNT_FILE_PATH)
+        for file_name in os.listdir(_DIR_PATH):
+            if file_name.startswith(ref_counts_file_name):
+                os.remove(os.path.join(_DIR_PATH, file_name))
+        for file_path in [_PATCHES_DATA_FILE_PATH, _JOURNAL_FILE_PATH]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        if os.path.isdir(_PATCH_SHARDS_DIR_PATH):
+            shutil.rmtree(_PATCH_SHARDS_DIR_PATH)
+
+class _SQLiteDataBaseStore:
+    """Persistent storage for the patch database in an SQLite database
+    with rows for each patch, file, essential file data and diff and for
+    each blob's reference count.  Changes are written as row level
+    updates of the patches marked as changed and, like the default
+    store, patches' files' data are loaded on demand.
+
+    NB: the database is in WAL mode only so that commits append to the
+    log rather than rewriting pages.  Sessions are still serialized by
+    the playground lock (readers can't run alongside a writer as blobs
+    outside the database are removed when no longer referenced) so WAL
+    doesn't provide any extra concurrency.
+    """
+    BACKEND = "sqlite"
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS patches (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            is_kept INTEGER NOT NULL,
+            series_index INTEGER,
+            applied_index INTEGER,
+            description TEXT NOT NULL,
+            pos_guards TEXT NOT NULL,
+            neg_guards TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS patches_name ON patches (name);
+        CREATE TABLE IF NOT EXISTS files (
+            patch_id INTEGER NOT NULL REFERENCES patches (id) ON DELETE CASCADE,
+            path TEXT NOT NULL,
+            came_from_path TEXT,
+            came_from_as_rename INTEGER,
+            renamed_as TEXT,
+            diff_is_stale INTEGER NOT NULL,
+            PRIMARY KEY (patch_id, path)
+        );
+        CREATE INDEX IF NOT EXISTS files_path ON files (path);
+        CREATE TABLE IF NOT EXISTS essential_file_data (
+            patch_id INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            role TEXT NOT NULL,
+            git_hash TEXT NOT NULL,
+            lstats BLOB NOT NULL,
+            PRIMARY KEY (patch_id, path, role),
+            FOREIGN KEY (patch_id, path) REFERENCES files (patch_id, path) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS essential_file_data_git_hash ON essential_file_data (git_hash);
+        CREATE TABLE IF NOT EXISTS diffs (
+            patch_id INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            diff_type TEXT NOT NULL,
+            diff_lines BLOB NOT NULL,
+            PRIMARY KEY (patch_id, path),
+            FOREIGN KEY (patch_id, path) REFERENCES files (patch_id, path) ON DELETE CASCADE
+        );
+        CREATE TABLE IF NOT EXISTS blob_ref_counts (
+            git_hash TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        );
+    """
+    def __init__(self, db_file_path=None):
+        self._conn = sqlite3.connect(db_file_path if db_file_path else _SQLITE_DB_FILE_PATH, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(self._SCHEMA)
+        self._selected_guards = set()
+        # NB: keep a reference to the patch data to prevent reuse of its id()
+        self._patch_rows = dict()
+    @staticmethod
+    def _guards_to_text(guards):
+        return "\n".join(sorted(guards))
+    @staticmethod
+    def _text_to_guards(text):
+        return set(text.split("\n")) if text else set()
+    def _load_files_data(self, patch_id):
+        efds = dict()
+        for path, role, git_hash, lstats in self._conn.execute("SELECT path, role, git_hash, lstats FROM essential_file_data WHERE patch_id = ?", (patch_id,)):
+            efds[(path, role)] = _EssentialFileData.new_dict(git_hash=git_hash, lstats=pickle.loads(lstats))
+        diffs_data = dict()
+        for path, diff_type, diff_lines in self._conn.execute("SELECT path, diff_type, diff_lines FROM diffs WHERE patch_id = ?", (patch_id,)):
+            diffs_data[path] = _DiffData.new_dict(diff_type=diff_type, diff_lines=pickle.loads(diff_lines))
+        files_data = dict()
+        for path, came_from_path, came_from_as_rename, renamed_as, diff_is_stale in self._conn.execute("SELECT path, came_from_path, came_from_as_rename, renamed_as, diff_is_stale FROM files WHERE patch_id = ?", (patch_id,)):
+            if came_from_path is None:
+                came_from = None
+            else:
+                came_from = _CameFromData.new_dict(file_path=came_from_path, as_rename=bool(came_from_as_rename), orig=efds.get((path, "came_from"), None))
+            files_data[path] = _FileData.new_dict(
+                orig=efds.get((path, "orig"), None),
+                darned=efds.get((path, "darned"), None),
+                came_from=came_from,
+                renamed_as=renamed_as,
+                diff=diffs_data.get(path, None),
+                diff_wrt=dict() if diff_is_stale else efds.get((path, "diff_wrt"), None),
+            )
+        return files_data
+    def load(self):
+        """Return the patches' persistent data and the blob reference counts"""
+        self._conn.execute("BEGIN")
+        try:
+            row = self._conn.execute("SELECT value FROM settings WHERE key = 'selected_guards'").fetchone()
+            self._selected_guards = self._text_to_guards(row[0]) if row else set()
+            file_paths = collections.defaultdict(list)
+            for patch_id, path in self._conn.execute("SELECT patch_id, path FROM files"):
+                file_paths[patch_id].append(path)
+            series = []
+            applied = []
+            kept_patches = dict()
+            for patch_id, name, is_kept, series_index, applied_index, description, pos_guards, neg_guards in self._conn.execute("SELECT * FROM patches"):
+                index_entry = {
+                    "name" : name,
+                    "description" : description,
+                    "pos_guards" : self._text_to_guards(pos_guards),
+                    "neg_guards" : self._text_to_guards(neg_guards),
+                    "file_paths" : file_paths[patch_id],
+                    "shard" : patch_id,
+                }
+                patch_data = _LazyPatchData(index_entry, self._load_files_data)
+                self._patch_rows[id(patch_data)] = (patch_id, (name, is_kept, series_index, applied_index), patch_data)
+                if is_kept:
+                    kept_patches[name] = patch_data
+                else:
+                    series.append((series_index, patch_data))
+                    if applied_index is not None:
+                        applied.append((applied_index, patch_data))
+            blob_ref_counts = _BlobRefCounts(self._load_ref_count_table)
+        finally:
+            self._conn.execute("COMMIT")
+        patches_data = _DataBaseData.new_dict(
+            selected_guards=set(self._selected_guards),
+            patch_series_data=[patch_data for _index, patch_data in sorted(series, key=lambda x: x[0])],
+            applied_patches_data=[patch_data for _index, patch_data in sorted(applied, key=lambda x: x[0])],
+            kept_patches=kept_patches,
+        )
+        return (patches_data, blob_ref_counts)
+    def _load_ref_count_table(self):
+        return _BlobRefCounts.make_table(self._conn.execute("SELECT git_hash, count FROM blob_ref_counts ORDER BY git_hash"))
+    def _insert_files_data(self, patch_id, files_data):
+        for path, file_data in files_data.items():
+            came_from = file_data["came_from"]
+            self._conn.execute(
+                "INSERT INTO files (patch_id, path, came_from_path, came_from_as_rename, renamed_as, diff_is_stale) VALUES (?, ?, ?, ?, ?, ?)",
+                (patch_id, path, came_from["file_path"] if came_from else None, came_from["as_rename"] if came_from else None, file_data["renamed_as"] or None, file_data["diff_wrt"] == dict())
+            )
+            efds = [("orig", file_data["orig"]), ("darned", file_data["darned"]), ("diff_wrt", file_data["diff_wrt"]), ("came_from", came_from["orig"] if came_from else None)]
+            for role, efd in efds:
+                if efd:
+                    self._conn.execute(
+                        "INSERT INTO essential_file_data (patch_id, path, role, git_hash, lstats) VALUES (?, ?, ?, ?, ?)",
+                        (patch_id, path, role, efd["git_hash"], pickle.dumps(efd["lstats"]))
+                    )
+            if file_data["diff"]:
+                self._conn.execute(
+                    "INSERT INTO diffs (patch_id, path, diff_type, diff_lines) VALUES (?, ?, ?, ?)",
+                    (patch_id, path, file_data["diff"]["diff_type"], pickle.dumps(file_data["diff"]["diff_lines"]))
+                )
+    def _write_patches(self, patches_data, changed_patches_data):
+        changed_ids = {id(patch_data) for patch_data in changed_patches_data}
+        applied_index = {id(patch_data) : index for index, patch_data in enumerate(patches_data["applied_patches_data"])}
+        placements = [(patch_data, (patch_data["name"], 0, index, applied_index.get(id(patch_data), None))) for index, patch_data in enumerate(patches_data["patch_series_data"])]
+        placements += [(patch_data, (name, 1, None, None)) for name, patch_data in patches_data["kept_patches"].items()]
+        patch_rows = dict()
+        for patch_data, placement in placements:
+            patch_id, old_placement, _patch_data = self._patch_rows.pop(id(patch_data), (None, None, None))
+            patch_values = placement + (patch_data["description"], self._guards_to_text(patch_data["pos_guards"]), self._guards_to_text(patch_data["neg_guards"]))
+            if patch_id is None:
+                patch_id = self._conn.execute("INSERT INTO patches (name, is_kept, series_index, applied_index, description, pos_guards, neg_guards) VALUES (?, ?, ?, ?, ?, ?, ?)", patch_values).lastrowid
+                self._insert_files_data(patch_id, patch_data["files_data"])
+            elif id(patch_data) in changed_ids or placement != old_placement:
+                self._conn.execute("UPDATE patches SET name = ?, is_kept = ?, series_index = ?, applied_index = ?, description = ?, pos_guards = ?, neg_guards = ? WHERE id = ?", patch_values + (patch_id,))
+                if id(patch_data) in changed_ids and not (isinstance(patch_data, _LazyPatchData) and not patch_data.is_loaded):
+                    self._conn.execute("DELETE FROM files WHERE patch_id = ?", (patch_id,))
+                    self._insert_files_data(patch_id, patch_data["files_data"])
+            patch_rows[id(patch_data)] = (patch_id, placement, patch_data)
+        # what's left are the patches that have been deleted
+        for patch_id, _placement, _patch_data in self._patch_rows.values():
+            self._conn.execute("DELETE FROM patches WHERE id = ?", (patch_id,))
+        self._patch_rows = patch_rows
+    def commit(self, patches_data, blob_ref_counts, changed_patches_data, changed_blob_hashes):
+        """Write the changes made to the data since it was loaded"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if patches_data["selected_guards"] != self._selected_guards:
+                self._conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('selected_guards', ?)", (self._guards_to_text(patches_data["selected_guards"]),))
+                self._selected_guards = set(patches_data["selected_guards"])
+            self._write_patches(patches_data, changed_patches_data)
+            for git_hash in changed_blob_hashes:
+                count = blob_ref_counts.get(git_hash)
+                if count:
+                    self._conn.execute("INSERT OR REPLACE INTO blob_ref_counts (git_hash, count) VALUES (?, ?)", (git_hash, count))
+                else:
+                    self._conn.execute("DELETE FROM blob_ref_counts WHERE git_hash = ?", (git_hash,))
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+    def compact(self, _blob_ref_counts):
+        """Fold the write ahead log back into the database"""
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    def close(self):
+        self._conn.close()
+    @classmethod
+    def create(cls, patches_data, blob_ref_counts):
+        """Create a store holding the given data"""
+        tmp_file_path = _SQLITE_DB_FILE_PATH + os.extsep + "tmp"
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        store = cls(tmp_file_path)
+        changed_blob_hashes = {git_hash for git_hash, _count in blob_ref_counts.items()}
+        store.commit(patches_data, blob_ref_counts, [], changed_blob_hashes)
+        store._conn.execute("PRAGMA journal_mode=DELETE")
+        store.close()
+        os.replace(tmp_file_path, _SQLITE_DB_FILE_PATH)
+    @staticmethod
+    def remove():
+        """Remove the store's files"""
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(_SQLITE_DB_FILE_PATH + suffix):
+                os.remove(_SQLITE_DB_FILE_PATH + suffix)
+
+_DB_STORES = {store.BACKEND : store for store in [_DataBaseStore, _SQLiteDataBaseStore]}
+DB_BACKENDS = sorted(_DB_STORES.keys())
+
+def _get_db_store():
+    return _SQLiteDataBaseStore() if os.path.exists(_SQLITE_DB_FILE_PATH) else _DataBaseStore()
+
 # Make a context manager for locking/opening/closing database
 @contextmanager
 def open_db(mutable=False):
     fd = os.open(_LOCK_FILE_PATH, os.O_RDWR if mutable else os.O_RDONLY)
     lock_db(fd, LOCK_EXCL if mutable else LOCK_READ)
-    with open(_PATCHES_DATA_FILE_PATH, "rb") as f_obj:
-        patches_data = pickle.load(f_obj)
-    with open(_BLOB_REF_COUNT_FILE_PATH, "rb") as f_obj:
-        blob_ref_counts = pickle.load(f_obj)
+    if mutable:
+        blob_format = "zlib" if options.get("blobs", "compress") else "raw"
+        if _read_blob_format() != blob_format:
+            _convert_blobs(blob_format)
+    store = _get_db_store()
+    patches_data, blob_ref_counts = store.load()
+    database = DataBase(patches_data, blob_ref_counts, mutable)
     try:
-        yield DataBase(patches_data, blob_ref_counts, mutable)
+        yield database
     finally:
-        if mutable:
+        if mutable and database.is_dirty:
             scount = os.read(fd, 255)
             os.lseek(fd, 0, 0)
             os.write(fd, str(int(scount) + 1).encode())
-            with open(_PATCHES_DATA_FILE_PATH, "wb") as f_obj:
-                pickle.dump(patches_data, f_obj)
-            with open(_BLOB_REF_COUNT_FILE_PATH, "wb") as f_obj:
-                pickle.dump(blob_ref_counts, f_obj)
+            store.commit(patches_data, blob_ref_counts, database.changed_patches_data, database.changed_blob_hashes)
+        store.close()
+        database.stat_cache.save()
+        database.diff_cache.trim()
+        database.close_blob_packs()
+        unlock_db(fd)
+        os.close(fd)
+
+def do_compact_db():
+    """Fold the database's change journal into its snapshot"""
+    fd = os.open(_LOCK_FILE_PATH, os.O_RDWR)
+    lock_db(fd, LOCK_EXCL)
+    try:
+        store = _get_db_store()
+        _patches_data, blob_ref_counts = store.load() # pylint: disable=unused-variable
+        store.compact(blob_ref_counts)
+        store.close()
+    finally:
+        unlock_db(fd)
+        os.close(fd)
+    return CmdResult.OK
+
+def do_gc():
+    """Compact the database and move its blobs into a pack"""
+    fd = os.open(_LOCK_FILE_PATH, os.O_RDWR)
+    lock_db(fd, LOCK_EXCL)
+    try:
+        store = _get_db_store()
+        patches_data, blob_ref_counts = store.load()
+        store.compact(blob_ref_counts)
+        # NB: the store stays open as the repack loads data on demand
+        database = DataBase(patches_data, blob_ref_counts, False)
+        try:
+            count, delta_count = database.repack_blobs("zlib" if options.get("blobs", "compress") else "raw")
+        except DarnItBadBlobPack as edata:
+            for git_hash in edata.bad_hashes:
+                RCTX.stderr.write(_("{0}: could not be read back from the new pack.\n").format(git_hash))
+            RCTX.stderr.write(_("Error: packing aborted.  No blobs have been removed.\n"))
+            return CmdResult.ERROR
+        finally:
+            database.close_blob_packs()
+            store.close()
+    finally:
         unlock_db(fd)
         os.close(fd)
+    RCTX.stdout.write(_("{0} blobs packed ({1} as deltas).\n").format(count, delta_count))
+    return CmdResult.OK
+
+def do_convert_db(backend):
+    """Convert the database to use the nominated storage backend"""
+    fd = os.open(_LOCK_FILE_PATH, os.O_RDWR)
+    lock_db(fd, LOCK_EXCL)
+    try:
+        store = _get_db_store()
+        if store.BACKEND == backend:
+            store.close()
+            RCTX.stderr.write(_("Database already uses the \"{0}\" backend.\n").format(backend))
+            return CmdResult.WARNING
+        patches_data, blob_ref_counts = store.load()
+        for patch_data in patches_data["patch_series_data"] + list(patches_data["kept_patches"].values()):
+            patch_data["files_data"] # NB: make sure that everything is loaded
+        blob_ref_counts.load()
+        store.close()
+        # NB: the new store's creation determines which backend is in use
+        # so the old store's files are only removed after it's complete
+        _DB_STORES[backend].create(patches_data, blob_ref_counts)
+        store.remove()
+    finally:
+        unlock_db(fd)
+        os.close(fd)
+    RCTX.stdout.write(_("Database converted to the \"{0}\" backend.\n").format(backend))
+    return CmdResult.OK
 
 ### Helper commands
 # The helper commands are wrappers for common functionality in the
@@ -1849,24 +3662,79 @@ def do_add_files_to_top_patch(file_paths, absorb=False, force=False):
                 RCTX.stderr.write(_("{0}: Unrefeshed changes in patch \"{2}\" incorporated in patch \"{1}\".\n").format(file_path_rel_subdir, top_patch.name, overlaps.unrefreshed[file_path].name))
         return CmdResult.WARNING if issued_warning else CmdResult.OK
 
-def do_apply_next_patch(absorb=False, force=False):
+def _apply_next_patch(db, absorb=False, force=False):
+    """Apply the next patch and report the outcome"""
+    try:
+        ecode = db.push_next_patch(absorb=absorb, force=force)
+    except DarnItNoPushablePatches:
+        if db.top_patch_name:
+            RCTX.stderr.write(_("No pushable patches. \"{0}\" is on top.\n").format(db.top_patch_name))
+        else:
+            RCTX.stderr.write(_("No pushable patches.\n"))
+        return CmdResult.ERROR
+    except DarnItPatchOverlapsChanges as edata:
+        return edata.overlaps.report_and_abort()
+    if ecode & CmdResult.ERROR:
+        RCTX.stderr.write(_("A refresh is required after issues are resolved.\n"))
+    elif db.top_patch.needs_refresh:
+        RCTX.stderr.write(_("A refresh is required.\n"))
+    RCTX.stdout.write(_("Patch \"{0}\" is now on top.\n").format(db.top_patch.name))
+    return ecode
+
+def _apply_patches_to(db, patch_name=None, absorb=False, force=False):
+    """Apply pushable patches until the named patch is on top (or
+    there are no more pushable patches if patch_name is None)
+    stopping at the first push that doesn't succeed cleanly.
+    """
+    while db.is_pushable:
+        ecode = _apply_next_patch(db, absorb=absorb, force=force)
+        if ecode != CmdResult.OK or db.top_patch_name == patch_name:
+            return ecode
+    return CmdResult.OK
+
+def _unapply_patches_to(db, patch_name=None, force=False):
+    """Unapply patches until the named patch is on top (or there are
+    no patches applied if patch_name is None) stopping at the first
+    pop that doesn't succeed cleanly.
+    """
+    while db.applied_patch_count > 0 and db.top_patch_name != patch_name:
+        ecode = _pop_top_patch(db, force=force)
+        if ecode != CmdResult.OK:
+            return ecode
+    return CmdResult.OK
+
+def _get_pushable_target_patch(patch_name, db):
+    """Return the named patch if it can be reached by pushing"""
+    patch = _get_patch(patch_name, db)
+    if patch is None:
+        return None
+    if patch.is_applied:
+        RCTX.stderr.write(_("Patch \"{0}\" is already applied.\n").format(patch_name))
+        return None
+    if patch.is_blocked_by_guard:
+        RCTX.stderr.write(_("Patch \"{0}\" is blocked by guard(s).\n").format(patch_name))
+        return None
+    if db.top_patch_name is not None:
+        if db.get_series_position(patch.name) < db.get_series_position(db.top_patch_name):
+            RCTX.stderr.write(_("Patch \"{0}\" is below the top patch and cannot be pushed.\n").format(patch_name))
+            return None
+    return patch
+
+def do_apply_next_patch(absorb=False, force=False, restore_mtime=None):
     with open_db(mutable=True) as DB:
-        try:
-            ecode = DB.push_next_patch(absorb=absorb, force=force)
-        except DarnItNoPushablePatches:
-            if DB.top_patch_name:
-                RCTX.stderr.write(_("No pushable patches. \"{0}\" is on top.\n").format(DB.top_patch_name))
-            else:
-                RCTX.stderr.write(_("No pushable patches.\n"))
+        if restore_mtime is not None: # value of True or False will override option
+            DB.restore_mtime_overrides["push"] = restore_mtime
+        return _apply_next_patch(DB, absorb=absorb, force=force)
+
+def do_apply_patches(to_patch_name=None, absorb=False, force=False, restore_mtime=None):
+    """Apply all pushable patches (or those up to and including the
+    named patch) within a single database session"""
+    with open_db(mutable=True) as DB:
+        if restore_mtime is not None: # value of True or False will override option
+            DB.restore_mtime_overrides["push"] = restore_mtime
+        if to_patch_name is not None and _get_pushable_target_patch(to_patch_name, DB) is None:
             return CmdResult.ERROR
-        except DarnItPatchOverlapsChanges as edata:
-            return edata.overlaps.report_and_abort()
-        if ecode & CmdResult.ERROR:
-            RCTX.stderr.write(_("A refresh is required after issues are resolved.\n"))
-        elif DB.top_patch.needs_refresh:
-            RCTX.stderr.write(_("A refresh is required.\n"))
-        RCTX.stdout.write(_("Patch \"{0}\" is now on top.\n").format(DB.top_patch.name))
-        return ecode
+        return _apply_patches_to(DB, to_patch_name, absorb=absorb, force=force)
 
 def do_copy_file_to_top_patch(file_path, as_file_path, overwrite=False):
     with open_db(mutable=True) as DB:
@@ -2123,22 +3991,44 @@ def do_move_files_in_top_patch(file_paths, target_path, force=False, overwrite=F
             RCTX.stdout.write(_("{0}: file renamed to \"{1}\" in patch \"{2}\".\n").format(rel_subdir(file_path), rel_subdir(target_file_path), top_patch.name))
         return CmdResult.OK
 
-def do_pop_top_patch(force=False):
+def _pop_top_patch(db, force=False):
+    """Unapply the top patch and report the outcome"""
+    try:
+        new_top_patch = db.pop_top_patch(force=force)
+    except DarnItNoPatchesApplied:
+        RCTX.stderr.write(_("There are no applied patches to pop."))
+        return CmdResult.ERROR
+    except DarnItPatchNeedsRefresh:
+        RCTX.stderr.write(_("Top patch (\"{0}\") needs to be refreshed.\n").format(db.top_patch_name))
+        return CmdResult.ERROR | CmdResult.Suggest.FORCE_OR_REFRESH
+    if new_top_patch is None:
+        RCTX.stdout.write(_("There are now no patches applied.\n"))
+    else:
+        RCTX.stdout.write(_("Patch \"{0}\" is now on top.\n").format(new_top_patch.name))
+    return CmdResult.OK
+
+def do_pop_top_patch(force=False, restore_mtime=None):
     # TODO: implement non dummy version do_unapply_top_patch()
     with open_db(mutable=True) as DB:
-        try:
-            new_top_patch = DB.pop_top_patch(force=force)
-        except DarnItNoPatchesApplied:
-            RCTX.stderr.write(_("There are no applied patches to pop."))
+        if restore_mtime is not None: # value of True or False will override option
+            DB.restore_mtime_overrides["pop"] = restore_mtime
+        return _pop_top_patch(DB, force=force)
+
+def do_goto_patch(patch_name, absorb=False, force=False, restore_mtime=None):
+    """Push or pop patches (within a single database session) until
+    the named patch is the top patch"""
+    with open_db(mutable=True) as DB:
+        if restore_mtime is not None: # value of True or False will override options
+            DB.restore_mtime_overrides["pop"] = restore_mtime
+            DB.restore_mtime_overrides["push"] = restore_mtime
+        patch = _get_patch(patch_name, DB)
+        if patch is None:
             return CmdResult.ERROR
-        except DarnItPatchNeedsRefresh:
-            RCTX.stderr.write(_("Top patch (\"{0}\") needs to be refreshed.\n").format(DB.top_patch_name))
-            return CmdResult.ERROR | CmdResult.Suggest.FORCE_OR_REFRESH
-        if new_top_patch is None:
-            RCTX.stdout.write(_("There are now no patches applied.\n"))
-        else:
-            RCTX.stdout.write(_("Patch \"{0}\" is now on top.\n").format(new_top_patch.name))
-        return CmdResult.OK
+        if patch.is_applied:
+            return _unapply_patches_to(DB, patch_name, force=force)
+        if _get_pushable_target_patch(patch_name, DB) is None:
+            return CmdResult.ERROR
+        return _apply_patches_to(DB, patch_name, absorb=absorb, force=force)
 
 def do_refresh_patch(patch_name=None):
     """Refresh the named (or top applied) patch"""
@@ -2156,6 +4046,28 @@ def do_refresh_patch(patch_name=None):
             RCTX.stdout.write(_("Patch \"{0}\" refreshed.\n").format(patch.name))
         return eflag
 
+def do_refresh_applied_patches():
+    """Refresh all of the applied patches (bottom up) in one session"""
+    with open_db(mutable=True) as DB:
+        if _get_top_patch(DB) is None:
+            return CmdResult.ERROR
+        # NB: a patch's refresh only depends on the content of its files'
+        # overlapping files (which is stored) so every file's before and
+        # after data can be worked out before any diffs are generated
+        # and all the diffs can then be generated together in parallel
+        prepared = [(patch,) + patch.prepare_refresh() for patch in DB.iterate_applied_patches()]
+        sides = [side for _patch, _eflag, refreshes, _skipped in prepared for side in Patch.get_refresh_sides_to_diff(refreshes)]
+        diffs = iter(DB.generate_diffs(sides))
+        eflag = CmdResult.OK
+        for patch, patch_eflag, refreshes, skipped in prepared:
+            patch.finish_refresh(refreshes, skipped, diffs, stdout=RCTX.stdout)
+            if patch_eflag != CmdResult.OK:
+                RCTX.stderr.write(_("Patch \"{0}\" requires another refresh after issues are resolved.\n").format(patch.name))
+                eflag = patch_eflag
+            else:
+                RCTX.stdout.write(_("Patch \"{0}\" refreshed.\n").format(patch.name))
+        return eflag
+
 def do_remove_patch(patch_name, retain_copy=None):
     with open_db(mutable=True) as DB:
         if retain_copy is None: # value of True or False will override option
@@ -2388,8 +4300,23 @@ def do_set_series_description(description):
         return CmdResult.ERROR
     return CmdResult.OK
 
-def do_unapply_top_patch(force=False):
-    return do_pop_top_patch(force=force)
+def do_unapply_top_patch(force=False, restore_mtime=None):
+    return do_pop_top_patch(force=force, restore_mtime=restore_mtime)
+
+def do_unapply_patches(to_patch_name=None, force=False, restore_mtime=None):
+    """Unapply all applied patches (or those above the named patch)
+    within a single database session"""
+    with open_db(mutable=True) as DB:
+        if restore_mtime is not None: # value of True or False will override option
+            DB.restore_mtime_overrides["pop"] = restore_mtime
+        if to_patch_name is not None:
+            patch = _get_patch(to_patch_name, DB)
+            if patch is None:
+                return CmdResult.ERROR
+            if not patch.is_applied:
+                RCTX.stderr.write(_("Patch \"{0}\" is not applied.\n").format(to_patch_name))
+                return CmdResult.ERROR
+        return _unapply_patches_to(DB, to_patch_name, force=force)
 
 # GETs
 
@@ -2406,9 +4333,19 @@ def all_applied_patches_refreshed():
     except OSError:
         return False
 
-def report_blobs_status():
+def report_blobs_status(full=False, verbose=False):
+    progress = [0, 0, 0]
+    def report_progress(done, total, byte_count):
+        progress[:] = [done, total, byte_count]
+        RCTX.stdout.write(_("Verifying blobs: {0}/{1}\r").format(done, total))
+        RCTX.stdout.flush()
+    start_time = time.time()
     with open_db(mutable=False) as DB:
-        content_check = DB.check_content()
+        content_check = DB.check_content(full=full, report_progress=report_progress if verbose else None)
+        if verbose:
+            elapsed = max(time.time() - start_time, 0.001)
+            mib_count = progress[2] / (1024 * 1024)
+            RCTX.stdout.write(_("Verified {0} blobs ({1:.1f} MiB) in {2:.2f}s ({3:.1f} MiB/s).\n").format(progress[0], mib_count, elapsed, mib_count / elapsed))
         ref_count_check = DB.validate_ref_counts()
         retval = CmdResult.OK
         if content_check.orphans:
@@ -2437,8 +4374,10 @@ def get_applied_patch_count():
         count = 0
     return count
 
-def get_combined_diff_for_files(file_paths, with_timestamps=False):
+def get_combined_diff_for_files(file_paths, with_timestamps=False, engine=None):
     with open_db(mutable=False) as DB:
+        if engine is not None:
+            DB.diff_engine = engine
         if DB.combined_patch is None:
             RCTX.stderr.write("No patches applied.\n")
             return ""
@@ -2476,8 +4415,10 @@ def get_combined_patch_file_table():
 def get_combined_textpatch(with_timestamps=False):
     return NotImplemented
 
-def get_diff_for_files(file_paths, patch_name, with_timestamps=False):
+def get_diff_for_files(file_paths, patch_name, with_timestamps=False, engine=None):
     with open_db(mutable=False) as DB:
+        if engine is not None:
+            DB.diff_engine = engine
         patch = _get_named_or_top_patch(patch_name, DB)
         if patch is None:
             return False
@@ -2492,8 +4433,9 @@ def get_diff_for_files(file_paths, patch_name, with_timestamps=False):
             file_iter = (patch.get_file(file_path) for file_path in base_file_paths)
         else:
             file_iter = patch.iterate_files_sorted()
-        diffs = (file_data.get_diff_text(with_timestamps=with_timestamps) for file_data in file_iter)
-        return "".join(diffs)
+        files_data = list(file_iter)
+        DB.prefetch_diff_lines(files_data, with_timestamps=with_timestamps)
+        return "".join(file_data.get_diff_text(with_timestamps=with_timestamps) for file_data in files_data)
 
 def get_diff_pluses_for_files(file_paths, patch_name, with_timestamps=False):
     with open_db(mutable=False) as DB:
@@ -2511,7 +4453,9 @@ def get_diff_pluses_for_files(file_paths, patch_name, with_timestamps=False):
             file_iter = (patch.get_file(file_path) for file_path in base_file_paths)
         else:
             file_iter = patch.iterate_files_sorted()
-        return [file_data.get_diff_plus(with_timestamps=with_timestamps) for file_data in file_iter]
+        files_data = list(file_iter)
+        DB.prefetch_diff_lines(files_data, with_timestamps=with_timestamps)
+        return [file_data.get_diff_plus(with_timestamps=with_timestamps) for file_data in files_data]
 
 def get_extdiff_files_for(file_path, patch_name):
     with open_db(mutable=False) as DB:
@@ -2541,17 +4485,13 @@ def get_outstanding_changes_below_top():
     with open_db(mutable=False) as DB:
         if DB.applied_patch_count == 0:
             return OverlapData()
-        skip_set = DB.top_patch.get_file_paths_set()
+        applied_file_paths = DB.get_applied_file_paths()
         unrefreshed = {}
-        for applied_patch in DB.iterate_applied_patches(stop=-1, backwards=True):
-            apfiles = applied_patch.get_filepaths()
-            if apfiles:
-                apfiles_set = set(apfiles) - skip_set
-                for apfile in apfiles_set:
-                    if applied_patch.get_file(apfile).needs_refresh:
-                        unrefreshed[apfile] = applied_patch
-                skip_set |= apfiles_set
-        uncommitted = set(scm_ifce.get_current_ifce().get_files_with_uncommitted_changes()) - skip_set
+        for apfile in applied_file_paths - DB.top_patch.get_file_paths_set():
+            applied_patch = Patch(DB.get_applied_patches_data_for_file(apfile)[-1], DB)
+            if applied_patch.get_file(apfile).needs_refresh:
+                unrefreshed[apfile] = applied_patch
+        uncommitted = set(scm_ifce.get_current_ifce().get_files_with_uncommitted_changes()) - applied_file_paths
         return OverlapData(unrefreshed=unrefreshed, uncommitted=uncommitted)
 
 def get_patch_description(patch_name):